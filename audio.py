@@ -1,56 +1,236 @@
 import datetime
+import mmap
+import numpy as np
 import pyaudio
 import re
-import wave
+import struct
+import threading
+import time
 
 from common import audio as audio_util
 from common import pattern
 
 
-def get_all_devices():
-  audio = pyaudio.PyAudio()
-  count = audio.get_device_count()
-  return [audio.get_device_info_by_index(i) for i in range(count)]
+class _Host(object):
+  """PyAudio instance shared by all streams.
+
+  PortAudio is initialized on first use and terminated when the last user
+  releases it. Devices are enumerated once, since PortAudio only rescans
+  them on initialization.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._audio = None
+    self._refs = 0
+    self._devices = None
+
+  def acquire(self):
+    with self._lock:
+      if not self._audio:
+        self._audio = pyaudio.PyAudio()
+      self._refs += 1
+      return self._audio
+
+  def release(self):
+    with self._lock:
+      self._refs -= 1
+      if not self._refs:
+        self._audio.terminate()
+        self._audio = None
+        self._devices = None
+
+  def devices(self, refresh=False):
+    with self._lock:
+      if refresh and not self._refs:
+        self._devices = None
+      if self._devices is None:
+        audio = self._audio or pyaudio.PyAudio()
+        count = audio.get_device_count()
+        self._devices = [
+            audio.get_device_info_by_index(i) for i in range(count)
+        ]
+        if audio is not self._audio:
+          audio.terminate()
+      return list(self._devices)
+
+
+_host = _Host()
+
+
+def get_all_devices(refresh=False):
+  """Gets info of all audio devices.
+
+  Args:
+    refresh: True to enumerate devices again, if no stream is open.
+  """
+  return _host.devices(refresh)
 
 
 class Audio(pattern.Worker, pattern.EventEmitter):
+  """Audio capture from an input device.
+
+  PyAudio delivers blocks on its own thread into a preallocated ring; the
+  worker thread emits them as int16 numpy views into that ring, so no copy
+  or decode is needed per listener. A view is only valid until the ring
+  wraps around (ring_blocks blocks later); listeners that keep samples
+  longer must copy them.
+
+  Events:
+    "sample": triggered for each block.
+      audio (Audio): timestamp and frame_index describe the block.
+      data (numpy.ndarray): int16 samples.
+    "spectrum": triggered for each block if there are listeners.
+      audio (Audio)
+      spectrum: power spectrum of the block.
+  """
 
   SAMPLE_SECONDS = 1
   FORMAT = pyaudio.paInt16
+  _ORIGIN_GAIN = 0.01
 
-  def __init__(self, name, sample_rate, *args, **kwargs):
+  def __init__(self,
+               name,
+               sample_rate,
+               block_size=None,
+               ring_blocks=None,
+               *args,
+               **kwargs):
+    """
+    Args:
+      name: regex matching name of input device.
+      sample_rate: samples per second.
+      block_size: frames per block; defaults to SAMPLE_SECONDS of audio.
+      ring_blocks: number of blocks in the ring; defaults to one second of
+        audio, and at least 4 blocks.
+    """
     super(Audio, self).__init__(
         worker_name='Audio - {0}'.format(name), *args, **kwargs)
 
     self._audio = None
     self._stream = None
     self._sample_rate = sample_rate
-    self._buffer_size = sample_rate * Audio.SAMPLE_SECONDS
+    self._block_size = block_size or sample_rate * Audio.SAMPLE_SECONDS
+    if not ring_blocks:
+      ring_blocks = max(4, -(-sample_rate // self._block_size))
+    self._ring = np.zeros((ring_blocks, self._block_size), dtype=np.int16)
+    self._ring_bytes = memoryview(self._ring).cast('B')
+    self._condition = threading.Condition()
+    self._timestamps = np.zeros(ring_blocks, dtype=np.float64)
+    self._written = 0
+    self._read = 0
+    self._origin = None
+    self._timestamp = None
+    self._frame_index = 0
+    self._overruns = 0
+    self._underruns = 0
     self._device_info = self._find_device(name)
 
     self.start()
 
+  @property
+  def sample_rate(self):
+    return self._sample_rate
+
+  @property
+  def block_size(self):
+    return self._block_size
+
+  @property
+  def timestamp(self):
+    """Gets time.monotonic() of the first frame of the current block."""
+    return self._timestamp
+
+  @property
+  def frame_index(self):
+    """Gets index of the first frame of the current block since start."""
+    return self._frame_index
+
+  @property
+  def overruns(self):
+    """Gets number of blocks lost because input overflowed or listeners
+    fell behind by more than the ring."""
+    return self._overruns
+
+  @property
+  def underruns(self):
+    """Gets number of blocks PortAudio reported as input underflow."""
+    return self._underruns
+
   def _on_start(self):
-    self._audio = pyaudio.PyAudio()
+    self._audio = _host.acquire()
     self._stream = self._audio.open(
         format=Audio.FORMAT,
         input=True,
         channels=1,
         rate=self._sample_rate,
         input_device_index=self._device_info['index'],
-        frames_per_buffer=self._buffer_size)
+        frames_per_buffer=self._block_size,
+        stream_callback=self._on_block)
+
+  def _on_block(self, in_data, frame_count, time_info, status):
+    # Runs on PortAudio's thread: copy into the ring and hand over.
+    now = time.monotonic()
+    slot = self._written % len(self._ring)
+    self._timestamps[slot] = self._update_origin(now)
+    size = self._block_size * 2
+    offset = slot * size
+    self._ring_bytes[offset:offset + len(in_data)] = in_data
+    if status & pyaudio.paInputOverflow:
+      self._overruns += 1
+    if status & pyaudio.paInputUnderflow:
+      self._underruns += 1
+    with self._condition:
+      self._written += 1
+      self._condition.notify()
+    return (None, pyaudio.paContinue)
 
   def _on_run(self):
-    data = self._stream.read(self._buffer_size)
-    self.emit('sample', self, data)
-    if self.emittable('spectrum'):
-      spectrum = audio_util.create_power_spectrum(data)
-      self.emit('spectrum', self, spectrum)
+    with self._condition:
+      if self._read == self._written:
+        self._condition.wait(1)
+      written = self._written
+
+    behind = written - self._read
+    if behind >= len(self._ring):
+      # Oldest blocks may already be overwritten.
+      lost = behind - len(self._ring) + 1
+      self._overruns += lost
+      self._read += lost
+
+    while self._read < written:
+      index = self._read
+      self._read += 1
+      slot = index % len(self._ring)
+      self._frame_index = index * self._block_size
+      self._timestamp = float(self._timestamps[slot])
+      data = self._ring[slot]
+      self.emit('sample', self, data)
+      if self.emittable('spectrum'):
+        spectrum = audio_util.create_power_spectrum(data.tobytes())
+        self.emit('spectrum', self, spectrum)
 
   def _on_stop(self):
     self._stream.stop_stream()
     self._stream.close()
-    self._audio.terminate()
+    self._audio = None
+    _host.release()
+
+  def _update_origin(self, now):
+    """Gets timestamp of the block just received.
+
+    The origin (time of frame 0) implied by a callback is late by the
+    callback's scheduling delay, so the earliest one is trusted; the slow
+    upward correction follows a device clock that runs slower than
+    time.monotonic().
+    """
+    frame = self._written * self._block_size
+    origin = now - float(frame + self._block_size) / self._sample_rate
+    if self._origin is None or origin < self._origin:
+      self._origin = origin
+    else:
+      self._origin += Audio._ORIGIN_GAIN * (origin - self._origin)
+    return self._origin + float(frame) / self._sample_rate
 
   def _find_device(self, name):
     devices = get_all_devices()
@@ -61,49 +241,328 @@ class Audio(pattern.Worker, pattern.EventEmitter):
     return device[0]
 
 
+class MultiAudio(pattern.EventEmitter):
+  """Synchronized capture from several input devices.
+
+  Each device is captured by its own Audio; blocks are placed on a common
+  timeline by their timestamps, so devices that start at different times or
+  whose clocks drift apart stay aligned to within a sample period (samples
+  are dropped or repeated as the drift accumulates).
+
+  Events:
+    "sample": triggered for each block covered by all devices.
+      audio (MultiAudio): timestamp and frame_index describe the block.
+      data (numpy.ndarray): int16 samples, one row per device. The array is
+        reused for the next block; copy it to keep it.
+  """
+
+  def __init__(self, names, sample_rate, block_size, buffer_seconds=1,
+               *args, **kwargs):
+    """
+    Args:
+      names: regexes matching names of input devices.
+      sample_rate: samples per second of all devices.
+      block_size: frames per block.
+      buffer_seconds: seconds of audio kept per device while waiting for
+        the other devices.
+    """
+    super(MultiAudio, self).__init__(*args, **kwargs)
+    self._sample_rate = sample_rate
+    self._block_size = block_size
+    self._lock = threading.Lock()
+    capacity = max(int(sample_rate * buffer_seconds), 2 * block_size)
+    self._buffers = np.zeros((len(names), capacity), dtype=np.int16)
+    self._output = np.zeros((len(names), block_size), dtype=np.int16)
+    # Per device: frames received, and frame index/timestamp of last block.
+    self._written = [0] * len(names)
+    self._anchors = [None] * len(names)
+    self._next = None
+    self._timestamp = None
+    self._frame_index = 0
+    self._overruns = 0
+    self._inputs = []
+    for i, name in enumerate(names):
+      audio = Audio(name, sample_rate, block_size=block_size)
+      audio.on('sample', self._make_handler(i))
+      self._inputs.append(audio)
+
+  @property
+  def inputs(self):
+    return list(self._inputs)
+
+  @property
+  def sample_rate(self):
+    return self._sample_rate
+
+  @property
+  def block_size(self):
+    return self._block_size
+
+  @property
+  def timestamp(self):
+    """Gets time.monotonic() of the first frame of the current block."""
+    return self._timestamp
+
+  @property
+  def frame_index(self):
+    """Gets index of the first frame of the current block since start."""
+    return self._frame_index
+
+  @property
+  def overruns(self):
+    """Gets number of blocks skipped because a device fell behind."""
+    return self._overruns
+
+  def stop(self):
+    for audio in self._inputs:
+      audio.stop()
+
+  def _make_handler(self, device):
+
+    def on_sample(audio, data):
+      self._on_sample(device, audio, data)
+
+    return on_sample
+
+  def _on_sample(self, device, audio, data):
+    with self._lock:
+      capacity = self._buffers.shape[1]
+      start = self._written[device] % capacity
+      size = len(data)
+      first = min(size, capacity - start)
+      self._buffers[device, start:start + first] = data[:first]
+      self._buffers[device, :size - first] = data[first:]
+      self._written[device] += size
+      self._anchors[device] = (self._written[device] - size, audio.timestamp)
+
+      if None in self._anchors:
+        return
+      if self._next is None:
+        # Start when the last device started.
+        self._next = max(anchor[1] for anchor in self._anchors)
+      self._emit_ready(capacity)
+
+  def _emit_ready(self, capacity):
+    duration = float(self._block_size) / self._sample_rate
+    while True:
+      starts = []
+      for device, (frame, timestamp) in enumerate(self._anchors):
+        start = frame + int(round((self._next - timestamp) *
+                                  self._sample_rate))
+        if start + self._block_size > self._written[device]:
+          return
+        if start < self._written[device] - capacity:
+          # Overwritten while waiting for a slower device.
+          self._overruns += 1
+          self._next += duration
+          self._frame_index += self._block_size
+          break
+        starts.append(start)
+      else:
+        for device, start in enumerate(starts):
+          start %= capacity
+          first = min(self._block_size, capacity - start)
+          output = self._output[device]
+          output[:first] = self._buffers[device, start:start + first]
+          output[first:] = self._buffers[device, :self._block_size - first]
+        self._timestamp = self._next
+        self.emit('sample', self, self._output)
+        self._next += duration
+        self._frame_index += self._block_size
+
+
+class WavFile(object):
+  """Memory-mapped 16-bit PCM WAV file.
+
+  Samples are exposed as an int16 numpy array backed by the mapping, so
+  slicing it does not read or copy anything until the samples are used.
+  """
+
+  _RIFF = struct.Struct('<4sI4s')
+  _CHUNK = struct.Struct('<4sI')
+  _FORMAT = struct.Struct('<HHIIHH')
+  _PCM = 1
+  _EXTENSIBLE = 0xFFFE
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    riff, _, wave_id = self._RIFF.unpack_from(self._mmap, 0)
+    if riff != b'RIFF' or wave_id != b'WAVE':
+      raise AudioException('{0} is not a WAV file.'.format(path))
+    fmt = None
+    pos = self._RIFF.size
+    while pos + self._CHUNK.size <= len(self._mmap):
+      chunk_id, size = self._CHUNK.unpack_from(self._mmap, pos)
+      pos += self._CHUNK.size
+      if chunk_id == b'fmt ':
+        fmt = self._FORMAT.unpack_from(self._mmap, pos)
+      elif chunk_id == b'data':
+        break
+      pos += size + (size & 1)
+    else:
+      raise AudioException('{0} has no data.'.format(path))
+
+    if (not fmt or fmt[0] not in (self._PCM, self._EXTENSIBLE) or
+        fmt[5] != 16):
+      raise AudioException('{0} is not 16-bit PCM.'.format(path))
+    self._channels = fmt[1]
+    self._sample_rate = fmt[2]
+    count = min(size, len(self._mmap) - pos) // (2 * self._channels)
+    self._samples = np.frombuffer(
+        self._mmap, dtype='<i2', count=count * self._channels,
+        offset=pos).reshape(count, self._channels)
+    if self._channels == 1:
+      self._samples = self._samples[:, 0]
+
+  @property
+  def sample_rate(self):
+    return self._sample_rate
+
+  @property
+  def channels(self):
+    return self._channels
+
+  @property
+  def samples(self):
+    """Gets all samples; 1-D if mono, else (frames, channels)."""
+    return self._samples
+
+  def __len__(self):
+    return len(self._samples)
+
+  def close(self):
+    self._samples = None
+    try:
+      self._mmap.close()
+    except BufferError:
+      # Views handed out are still alive; the mapping is released with the
+      # last of them.
+      pass
+
+
 class AudioFromFile(pattern.Worker, pattern.EventEmitter):
+  """Replays a WAV file as an audio source.
 
-  _ONE_SECOND = datetime.timedelta(seconds=1)
+  Blocks are zero-copy views into the memory-mapped file and are paced by
+  sleeping until each is due, at real time or any multiple of it.
 
-  def __init__(self, path, clock, *args, **kwargs):
+  Events:
+    "sample": triggered for each block.
+      audio (AudioFromFile): timestamp and frame_index describe the block.
+      data (numpy.ndarray): int16 samples; 1-D if mono, else
+        (frames, channels).
+    "end": triggered at the end of the file.
+      audio (AudioFromFile)
+  """
+
+  def __init__(self,
+               path,
+               clock=None,
+               block_size=None,
+               speed=1.0,
+               autostart=True,
+               *args,
+               **kwargs):
+    """
+    Args:
+      path: WAV file (16-bit PCM).
+      clock: unused; kept for compatibility. Pacing is set by speed.
+      block_size: frames per block; defaults to one second.
+      speed: replay speed relative to real time (e.g. 1 or 10), or None to
+        replay as fast as possible.
+      autostart: whether to start replay immediately. Pass False to
+        subscribe to events first and then call start(), so that no block
+        is emitted before the listeners exist.
+    """
     super(AudioFromFile, self).__init__(
         worker_name='AudioFromFile', *args, **kwargs)
     self._path = path
-    self._clock = clock
-    self._timestamp = datetime.timedelta(seconds=0)
+    self._file = WavFile(path)
+    self._block_size = block_size or self._file.sample_rate
+    self._speed = speed
+    self._lock = threading.Lock()
+    self._position = 0
+    self._frame_index = 0
+    self._start_time = None
 
-    self.start()
+    if autostart:
+      self.start()
+
+  @property
+  def sample_rate(self):
+    return self._file.sample_rate
+
+  @property
+  def channels(self):
+    return self._file.channels
+
+  @property
+  def block_size(self):
+    return self._block_size
+
+  @property
+  def duration(self):
+    return float(len(self._file)) / self._file.sample_rate
+
+  @property
+  def frame_index(self):
+    """Gets index of the first frame of the current block in the file."""
+    return self._frame_index
 
   @property
   def timestamp(self):
-    return self._timestamp
+    """Gets seconds from start of the file to the current block."""
+    return float(self._frame_index) / self._file.sample_rate
+
+  def seek(self, timestamp):
+    """Continues replay from a position.
+
+    Args:
+      timestamp: seconds (or datetime.timedelta) from start of the file.
+    """
+    if isinstance(timestamp, datetime.timedelta):
+      timestamp = timestamp.total_seconds()
+    position = int(round(timestamp * self._file.sample_rate))
+    with self._lock:
+      self._position = min(max(position, 0), len(self._file))
+      self._start_time = None
+
+  def close(self):
+    """Stops replay and releases the file."""
+    self.stop()
+    self._file.close()
 
   def _on_start(self):
-    self._file = wave.open(self._path, 'rb')
-    self._frames_per_sec = self._file.getnchannels() * self._file.getframerate(
-    )
-    self._nframes = self._file.getnframes()
-    self._start_time = self._clock.utc
-    self._timestamp = datetime.timedelta(seconds=0)
+    with self._lock:
+      self._start_time = None
 
   def _on_run(self):
-    if self._nframes <= 0:
+    with self._lock:
+      position = self._position
+      ended = position >= len(self._file)
+      if not ended:
+        self._position = position + self._block_size
+      if ended or not self._speed:
+        delay = 0
+      else:
+        rate = self._file.sample_rate * self._speed
+        now = time.monotonic()
+        if self._start_time is None:
+          self._start_time = now - position / rate
+        delay = self._start_time + position / rate - now
+
+    # Emitted outside the lock so that handlers can seek().
+    if ended:
       self.logger.debug('Reached end of audio file.')
       self.emit('end', self)
       return False
-
-    if self._clock.utc < self._start_time + self._timestamp:
-      return
-
-    frames = self._file.readframes(self._frames_per_sec)
-    self._nframes -= self._frames_per_sec
-    self.emit('sample', self, frames)
-    self._timestamp += AudioFromFile._ONE_SECOND
-
-  def _on_stop(self):
-    if self._file:
-      self._file.close()
-      self._file = None
+    if delay > 0:
+      time.sleep(delay)
+    self._frame_index = position
+    self.emit('sample', self,
+              self._file.samples[position:position + self._block_size])
 
 
 class AudioException(Exception):
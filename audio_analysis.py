@@ -0,0 +1,445 @@
+"""Analysis stages for audio.Audio blocks.
+
+A stage subscribes to the "sample" event of an audio source (audio.Audio or
+anything emitting the same event with sample_rate, frame_index and
+timestamp) and emits its own events. Stages keep all their working buffers
+preallocated, so processing a block does not allocate per frame.
+"""
+
+import abc
+import collections
+import concurrent.futures
+
+import numpy as np
+
+from common import pattern
+
+_FULL_SCALE = 32768.0
+# Floor for power in dB, to keep silence finite.
+_MIN_POWER = 1e-12
+
+Detection = collections.namedtuple(
+    'Detection', ['name', 'frame_index', 'timestamp', 'value'])
+"""A detected event; frame_index and timestamp are of its first sample."""
+
+
+class SpectrumAnalyzer(pattern.EventEmitter):
+  """Short-time power spectrum over overlapping windows.
+
+  A frame of fft_size samples is analyzed every hop_size samples,
+  independent of the source's block size. The spectrum is either per rFFT
+  bin or, with bands, summed over logarithmically spaced bands.
+
+  Events:
+    "spectrum": triggered for each frame.
+      analyzer (SpectrumAnalyzer): timestamp and frame_index describe the
+        frame.
+      spectrum (numpy.ndarray): power per bin or band, relative to full
+        scale. The array is reused for the next frame; copy it to keep it.
+  """
+
+  def __init__(self,
+               audio,
+               fft_size=1024,
+               hop_size=None,
+               bands=None,
+               min_frequency=50.0,
+               *args,
+               **kwargs):
+    """
+    Args:
+      audio: source to analyze.
+      fft_size: samples per frame.
+      hop_size: samples between frames; defaults to half of fft_size.
+      bands: number of log-spaced bands from min_frequency to Nyquist, or
+        None for the full spectrum. Bands narrower than a bin are merged,
+        so fewer bands may be produced.
+      min_frequency: lower edge (Hz) of the first band.
+    """
+    super(SpectrumAnalyzer, self).__init__(*args, **kwargs)
+    self._sample_rate = audio.sample_rate
+    self._fft_size = fft_size
+    self._hop_size = hop_size or fft_size // 2
+    if not 0 < self._hop_size <= fft_size:
+      raise ValueError('Hop size must be in (0, {0}]: {1}'.format(
+          fft_size, self._hop_size))
+
+    self._window = (np.hanning(fft_size) / _FULL_SCALE).astype(np.float32)
+    self._buffer = np.zeros(fft_size, dtype=np.float32)
+    self._frame = np.zeros(fft_size, dtype=np.float32)
+    self._filled = 0
+    bins = fft_size // 2 + 1
+    self._fft = np.zeros(bins, dtype=np.complex128)
+    self._magnitude = np.zeros(bins, dtype=np.float64)
+    self._power = np.zeros(bins, dtype=np.float64)
+    self._bin_frequencies = np.fft.rfftfreq(fft_size, 1.0 / self._sample_rate)
+    if bands:
+      edges = np.geomspace(min_frequency, self._sample_rate / 2.0, bands + 1)
+      starts = np.unique(
+          np.clip(
+              np.round(edges[:-1] * fft_size / self._sample_rate).astype(int),
+              0, bins - 1))
+      self._band_starts = starts
+      self._spectrum = np.zeros(len(starts), dtype=np.float64)
+      self._frequencies = self._bin_frequencies[starts]
+    else:
+      self._band_starts = None
+      self._spectrum = self._power
+      self._frequencies = self._bin_frequencies
+
+    # np.fft caches its plan (twiddle factors) per size after the first
+    # call; writing into a preallocated output needs numpy 2.0.
+    try:
+      np.fft.rfft(self._frame, out=self._fft)
+      self._rfft_out = True
+    except TypeError:
+      self._rfft_out = False
+
+    self._frame_index = None
+    self._timestamp = None
+    audio.on('sample', self.process)
+
+  @property
+  def fft_size(self):
+    return self._fft_size
+
+  @property
+  def hop_size(self):
+    return self._hop_size
+
+  @property
+  def frequencies(self):
+    """Gets frequency (Hz) of each bin, or lower edge of each band."""
+    return self._frequencies
+
+  @property
+  def frame_index(self):
+    """Gets index of the first sample of the current frame."""
+    return self._frame_index
+
+  @property
+  def timestamp(self):
+    """Gets time.monotonic() of the first sample of the current frame."""
+    return self._timestamp
+
+  def process(self, audio, data):
+    """Consumes a block of int16 samples; "sample" event handler."""
+    buf = self._buffer
+    hop = self._hop_size
+    pos = 0
+    size = len(data)
+    while pos < size:
+      take = min(self._fft_size - self._filled, size - pos)
+      buf[self._filled:self._filled + take] = data[pos:pos + take]
+      self._filled += take
+      pos += take
+      if self._filled == self._fft_size:
+        self._analyze(audio, pos)
+        buf[:-hop] = buf[hop:]
+        self._filled -= hop
+
+  def _analyze(self, audio, end):
+    # end is the position in the current block just past the frame.
+    offset = end - self._fft_size
+    self._frame_index = audio.frame_index + offset
+    self._timestamp = (audio.timestamp + float(offset) / self._sample_rate
+                       if audio.timestamp is not None else None)
+
+    np.multiply(self._buffer, self._window, out=self._frame)
+    if self._rfft_out:
+      np.fft.rfft(self._frame, out=self._fft)
+    else:
+      self._fft[:] = np.fft.rfft(self._frame)
+    np.absolute(self._fft, out=self._magnitude)
+    np.square(self._magnitude, out=self._power)
+    if self._band_starts is not None:
+      np.add.reduceat(self._power, self._band_starts, out=self._spectrum)
+    self.emit('spectrum', self, self._spectrum)
+
+
+class Detector(abc.ABC):
+  """Base of detectors run by DetectorPipeline.
+
+  Samples are analyzed in frames of frame_size. A frame that straddles two
+  blocks is completed with the next block, so the cost of a block depends
+  only on its size.
+  """
+
+  def __init__(self, sample_rate, frame_size):
+    self._sample_rate = sample_rate
+    self._frame_size = frame_size
+    self._buffer = np.zeros(0, dtype=np.float32)
+    self._carry = 0
+
+  @property
+  def frame_size(self):
+    return self._frame_size
+
+  def process(self, data):
+    """Analyzes a block of int16 samples.
+
+    Returns:
+      List of (event, name, offset, value): event is "voice_start",
+      "voice_stop" or "event"; offset is the index of the first sample of
+      the detection relative to the block (negative for samples carried
+      over from the previous block).
+    """
+    carry = self._carry
+    size = carry + len(data)
+    if len(self._buffer) < size:
+      buf = np.zeros(size, dtype=np.float32)
+      buf[:carry] = self._buffer[:carry]
+      self._buffer = buf
+    buf = self._buffer
+    np.multiply(data, 1.0 / _FULL_SCALE, out=buf[carry:size],
+                casting='unsafe')
+
+    count = size // self._frame_size
+    used = count * self._frame_size
+    results = []
+    if count:
+      frames = buf[:used].reshape(count, self._frame_size)
+      results = self._detect(frames, -carry)
+    buf[:size - used] = buf[used:size]
+    self._carry = size - used
+    return results
+
+  @abc.abstractmethod
+  def _detect(self, frames, offset):
+    """Analyzes complete frames.
+
+    Args:
+      frames: (count, frame_size) float32 samples scaled to [-1, 1).
+      offset: offset of the first frame relative to the block.
+    Returns:
+      Same as process().
+    """
+
+
+class EnergyVad(Detector):
+  """Voice activity detection by short-time energy and zero-crossing rate.
+
+  A frame is voiced when it is louder than threshold and crosses zero less
+  often than max_zcr (broadband noise crosses zero far more often than
+  voiced speech). Voice starts after attack voiced frames in a row and
+  stops after release unvoiced frames in a row.
+  """
+
+  def __init__(self,
+               sample_rate,
+               frame_size=None,
+               threshold=-45.0,
+               max_zcr=0.35,
+               attack=3,
+               release=30):
+    """
+    Args:
+      sample_rate: samples per second.
+      frame_size: samples per frame; defaults to 10ms.
+      threshold: energy threshold in dB relative to full scale.
+      max_zcr: maximum zero crossings per sample of a voiced frame.
+      attack: voiced frames needed to start voice.
+      release: unvoiced frames needed to stop voice.
+    """
+    super(EnergyVad, self).__init__(sample_rate, frame_size or
+                                    sample_rate // 100)
+    self._threshold = 10**(threshold / 10.0)
+    self._max_zcr = max_zcr
+    self._attack = attack
+    self._release = release
+    self._active = False
+    self._run = 0
+
+  @property
+  def active(self):
+    return self._active
+
+  def _detect(self, frames, offset):
+    energy = np.einsum('ij,ij->i', frames, frames) / frames.shape[1]
+    signs = np.signbit(frames)
+    crossings = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1)
+    voiced = ((energy > self._threshold) &
+              (crossings < self._max_zcr * frames.shape[1]))
+
+    results = []
+    for i, frame_voiced in enumerate(voiced.tolist()):
+      if frame_voiced == self._active:
+        self._run = 0
+        continue
+      self._run += 1
+      if self._run >= (self._release if self._active else self._attack):
+        self._active = not self._active
+        start = offset + (i - self._run + 1) * self._frame_size
+        event = 'voice_start' if self._active else 'voice_stop'
+        results.append((event, 'vad', start, None))
+        self._run = 0
+    return results
+
+
+class BandEnergyTrigger(Detector):
+  """Triggers when energy in a frequency band rises above a threshold.
+
+  The value of each detection is the band level in dB relative to full
+  scale.
+  """
+
+  def __init__(self,
+               sample_rate,
+               low,
+               high,
+               threshold=-40.0,
+               frame_size=512,
+               name='band'):
+    """
+    Args:
+      sample_rate: samples per second.
+      low: lower edge of the band in Hz.
+      high: upper edge of the band in Hz.
+      threshold: level in dB relative to full scale.
+      frame_size: samples per frame.
+      name: name of detections.
+    """
+    super(BandEnergyTrigger, self).__init__(sample_rate, frame_size)
+    self._name = name
+    self._threshold = threshold
+    window = np.hanning(frame_size).astype(np.float32)
+    self._window = window
+    self._low = int(np.ceil(low * frame_size / float(sample_rate)))
+    self._high = int(np.floor(high * frame_size / float(sample_rate))) + 1
+    # Scales sum of bin powers to mean square of the band's signal.
+    self._scale = 2.0 / (frame_size * np.sum(window * window))
+    self._above = False
+
+  def _detect(self, frames, offset):
+    spectrum = np.fft.rfft(frames * self._window, axis=1)
+    band = spectrum[:, self._low:self._high]
+    power = np.einsum('ij,ij->i', band.real, band.real) + np.einsum(
+        'ij,ij->i', band.imag, band.imag)
+    levels = 10 * np.log10(power * self._scale + _MIN_POWER)
+
+    results = []
+    for i, level in enumerate(levels.tolist()):
+      above = level > self._threshold
+      if above and not self._above:
+        results.append(('event', self._name, offset + i * self._frame_size,
+                        level))
+      self._above = above
+    return results
+
+
+class OnsetDetector(Detector):
+  """Detects sudden sounds by spectral flux.
+
+  Flux is the summed increase of spectral magnitude from one frame to the
+  next; an onset is a frame whose flux exceeds sensitivity times its
+  running average. The value of each detection is that ratio.
+  """
+
+  _AVERAGE_GAIN = 0.05
+  # Flux of noise far below audibility (about -80dB relative to full scale).
+  _MIN_FLUX = 0.01
+
+  def __init__(self,
+               sample_rate,
+               frame_size=512,
+               sensitivity=4.0,
+               min_interval=0.1,
+               name='onset'):
+    """
+    Args:
+      sample_rate: samples per second.
+      frame_size: samples per frame.
+      sensitivity: flux to average flux ratio of an onset.
+      min_interval: minimum seconds between onsets.
+      name: name of detections.
+    """
+    super(OnsetDetector, self).__init__(sample_rate, frame_size)
+    self._name = name
+    self._sensitivity = sensitivity
+    self._min_frames = int(min_interval * sample_rate / frame_size)
+    self._window = np.hanning(frame_size).astype(np.float32)
+    self._previous = np.zeros(frame_size // 2 + 1, dtype=np.float32)
+    self._average = None
+    self._since = self._min_frames
+
+  def _detect(self, frames, offset):
+    magnitude = np.abs(np.fft.rfft(frames * self._window, axis=1))
+    change = np.diff(magnitude, axis=0, prepend=self._previous[np.newaxis])
+    flux = np.sum(np.maximum(change, 0), axis=1)
+    self._previous[:] = magnitude[-1]
+
+    results = []
+    for i, value in enumerate(flux.tolist()):
+      self._since += 1
+      if self._average is None:
+        self._average = value
+        continue
+      # Floored so that the first sound after digital silence counts.
+      ratio = value / max(self._average, self._MIN_FLUX)
+      if ratio > self._sensitivity and self._since > self._min_frames:
+        results.append(('event', self._name, offset + i * self._frame_size,
+                        ratio))
+        self._since = 0
+      self._average += self._AVERAGE_GAIN * (value - self._average)
+    return results
+
+
+class DetectorPipeline(pattern.Logger, pattern.EventEmitter):
+  """Runs detectors on the blocks of an audio source.
+
+  Detectors run on the capture thread, or with background=True on a single
+  worker thread so that slow detectors do not delay other listeners (each
+  block is then copied, since the source reuses its buffers).
+
+  Events:
+    "voice_start": voice activity started.
+      pipeline (DetectorPipeline)
+      detection (Detection)
+    "voice_stop": voice activity stopped.
+      pipeline (DetectorPipeline)
+      detection (Detection)
+    "event": a sound event was detected.
+      pipeline (DetectorPipeline)
+      detection (Detection)
+  """
+
+  def __init__(self, audio, detectors, background=False, *args, **kwargs):
+    """
+    Args:
+      audio: source to analyze.
+      detectors: list of Detector.
+      background: True to run detectors on a worker thread.
+    """
+    super(DetectorPipeline, self).__init__(*args, **kwargs)
+    self._sample_rate = audio.sample_rate
+    self._detectors = list(detectors)
+    self._executor = (concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                      if background else None)
+    audio.on('sample', self._on_sample)
+
+  @property
+  def detectors(self):
+    return list(self._detectors)
+
+  def close(self):
+    if self._executor:
+      self._executor.shutdown(wait=True)
+      self._executor = None
+
+  def _on_sample(self, audio, data):
+    if self._executor:
+      self._executor.submit(self._run, data.copy(), audio.frame_index,
+                            audio.timestamp)
+    else:
+      self._run(data, audio.frame_index, audio.timestamp)
+
+  def _run(self, data, frame_index, timestamp):
+    try:
+      for detector in self._detectors:
+        for event, name, offset, value in detector.process(data):
+          self.emit(event, self,
+                    Detection(name, frame_index + offset,
+                              (timestamp + float(offset) / self._sample_rate
+                               if timestamp is not None else None), value))
+    except Exception as e:
+      self.logger.exception('Detector failed: {0}'.format(e))
@@ -0,0 +1,270 @@
+"""Event-triggered audio recording.
+
+Recorder keeps the last few seconds of an audio source in a fixed-size ring
+and only writes to disk around triggers. Encoding runs on the recorder's own
+worker thread; FLAC and Opus need the optional soundfile package, without
+which files are written as WAV.
+"""
+
+import datetime
+import os
+import queue
+import threading
+import wave
+
+import numpy as np
+
+from common import pattern
+
+try:
+  import soundfile
+except ImportError:
+  soundfile = None
+
+# format: (extension, soundfile format, soundfile subtype)
+_FORMATS = {
+    'wav': ('wav', None, None),
+    'flac': ('flac', 'FLAC', 'PCM_16'),
+    'opus': ('ogg', 'OGG', 'OPUS'),
+}
+
+_DATA = 1
+_END = 2
+
+
+class _WavWriter(object):
+
+  def __init__(self, path, sample_rate, channels):
+    self._file = wave.open(path, 'wb')
+    self._file.setnchannels(channels)
+    self._file.setsampwidth(2)
+    self._file.setframerate(sample_rate)
+
+  def write(self, data):
+    self._file.writeframes(np.ascontiguousarray(data, dtype='<i2').tobytes())
+
+  def close(self):
+    self._file.close()
+
+
+class _SoundFileWriter(object):
+
+  def __init__(self, path, sample_rate, channels, format, subtype):
+    self._file = soundfile.SoundFile(
+        path, 'w', samplerate=sample_rate, channels=channels, format=format,
+        subtype=subtype)
+
+  def write(self, data):
+    self._file.write(data)
+
+  def close(self):
+    self._file.close()
+
+
+class Recorder(pattern.Worker, pattern.EventEmitter):
+  """Records audio around triggers.
+
+  trigger() writes the pre-trigger ring to a new file and keeps recording
+  until post_trigger seconds after the last trigger. Recordings longer than
+  chunk_seconds are split into several files. A DetectorPipeline can drive
+  it directly:
+    pipeline.on('event', recorder.on_detection)
+
+  Events:
+    "file": triggered when a file is complete.
+      recorder (Recorder)
+      path (str)
+  """
+
+  def __init__(self,
+               audio,
+               directory,
+               pre_trigger=5.0,
+               post_trigger=5.0,
+               chunk_seconds=60.0,
+               format='flac',
+               prefix='audio',
+               *args,
+               **kwargs):
+    """
+    Args:
+      audio: source to record.
+      directory: directory to write files to.
+      pre_trigger: seconds before a trigger to include.
+      post_trigger: seconds after the last trigger to include.
+      chunk_seconds: maximum seconds per file.
+      format: 'wav', 'flac' or 'opus'.
+      prefix: prefix of file names.
+    """
+    super(Recorder, self).__init__(worker_name='Recorder', *args, **kwargs)
+    if format not in _FORMATS:
+      raise ValueError('Unsupported format: {0}'.format(format))
+    if format != 'wav' and not soundfile:
+      self.logger.warn(
+          'soundfile is not installed; recording WAV instead of {0}.'.format(
+              format))
+      format = 'wav'
+    self._format = _FORMATS[format]
+    self._directory = directory
+    self._prefix = prefix
+    self._sample_rate = audio.sample_rate
+    self._channels = getattr(audio, 'channels', 1)
+    self._post_frames = int(post_trigger * self._sample_rate)
+    self._chunk_frames = int(chunk_seconds * self._sample_rate)
+
+    shape = (int(pre_trigger * self._sample_rate),)
+    if self._channels > 1:
+      shape += (self._channels,)
+    self._ring = np.zeros(shape, dtype=np.int16)
+    self._ring_written = 0
+    self._frame_index = 0
+    self._stop_frame = None
+    self._active = False
+    self._lock = threading.Lock()
+    self._queue = queue.Queue()
+
+    self._writer = None
+    self._path = None
+    self._file_frames = 0
+
+    audio.on('sample', self._on_sample)
+    self.start()
+
+  @property
+  def recording(self):
+    return self._stop_frame is not None
+
+  def trigger(self):
+    """Starts or extends a recording."""
+    with self._lock:
+      if not self._active:
+        return
+      if self._stop_frame is None:
+        # The ring ends at the latest block, which has just been captured.
+        frames = self._ring_frames()
+        wall_time = datetime.datetime.now() - datetime.timedelta(
+            seconds=float(frames) / self._sample_rate)
+        self._queue.put((_DATA, self._frame_index - frames, wall_time,
+                         self._ring_contents()))
+      self._stop_frame = self._frame_index + self._post_frames
+
+  def on_detection(self, pipeline, detection):
+    """Triggers on a detection; DetectorPipeline event handler."""
+    self.trigger()
+
+  def _on_sample(self, audio, data):
+    # Runs on the capture thread: only copy, never encode here.
+    frame_index = audio.frame_index
+    end = frame_index + len(data)
+    with self._lock:
+      if not self._active:
+        return
+      if self._stop_frame is not None:
+        count = min(len(data), self._stop_frame - frame_index)
+        if count > 0:
+          wall_time = datetime.datetime.now() - datetime.timedelta(
+              seconds=float(len(data)) / self._sample_rate)
+          self._queue.put(
+              (_DATA, frame_index, wall_time, data[:count].copy()))
+        if end >= self._stop_frame:
+          self._stop_frame = None
+          self._queue.put((_END, None, None, None))
+      self._append_ring(data)
+      self._frame_index = end
+
+  def _append_ring(self, data):
+    size = len(self._ring)
+    if not size:
+      return
+    if len(data) >= size:
+      self._ring[:] = data[-size:]
+      self._ring_written += len(data)
+      return
+    start = self._ring_written % size
+    first = min(len(data), size - start)
+    self._ring[start:start + first] = data[:first]
+    self._ring[:len(data) - first] = data[first:]
+    self._ring_written += len(data)
+
+  def _ring_frames(self):
+    return min(self._ring_written, len(self._ring))
+
+  def _ring_contents(self):
+    size = len(self._ring)
+    if not size:
+      return self._ring[:0].copy()
+    if self._ring_written < size:
+      return self._ring[:self._ring_written].copy()
+    start = self._ring_written % size
+    return np.concatenate((self._ring[start:], self._ring[:start]))
+
+  def _on_start(self):
+    with self._lock:
+      self._active = True
+
+  def _on_run(self):
+    try:
+      item = self._queue.get(timeout=1)
+    except queue.Empty:
+      return
+    self._process(*item)
+
+  def _process(self, command, frame_index, wall_time, data):
+    """Writes queued data.
+
+    Args:
+      command: _DATA or _END.
+      frame_index: index of the first frame of data in the source.
+      wall_time: datetime at which the first frame of data was captured.
+      data: samples.
+    """
+    if command == _END:
+      self._close_file()
+      return
+
+    while len(data):
+      if not self._writer:
+        self._open_file(frame_index, wall_time)
+      count = min(len(data), self._chunk_frames - self._file_frames)
+      self._writer.write(data[:count])
+      self._file_frames += count
+      frame_index += count
+      wall_time += datetime.timedelta(
+          seconds=float(count) / self._sample_rate)
+      data = data[count:]
+      if self._file_frames >= self._chunk_frames:
+        self._close_file()
+
+  def _open_file(self, frame_index, wall_time):
+    extension, format, subtype = self._format
+    name = '{0}-{1:%Y%m%d-%H%M%S}-{2}.{3}'.format(
+        self._prefix, wall_time, frame_index, extension)
+    self._path = os.path.join(self._directory, name)
+    self.logger.debug('Recording to {0}...'.format(self._path))
+    if format:
+      self._writer = _SoundFileWriter(self._path, self._sample_rate,
+                                      self._channels, format, subtype)
+    else:
+      self._writer = _WavWriter(self._path, self._sample_rate,
+                                self._channels)
+    self._file_frames = 0
+
+  def _close_file(self):
+    if not self._writer:
+      return
+    self._writer.close()
+    self._writer = None
+    self.emit('file', self, self._path)
+
+  def _on_stop(self):
+    # Samples keep arriving from the source; stop queueing them.
+    with self._lock:
+      self._active = False
+      self._stop_frame = None
+    while True:
+      try:
+        item = self._queue.get_nowait()
+      except queue.Empty:
+        break
+      self._process(*item)
+    self._close_file()
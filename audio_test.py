@@ -4,6 +4,7 @@ import time
 import wave
 
 from hal import audio
+from hal import audio_analysis
 from common import audio as audio_util
 
 file = None
@@ -33,14 +34,48 @@ def test_audio():
   file.close()
 
 
+def test_spectrum():
+  a = audio.Audio(
+      name='C-Media USB Headphone Set.*', sample_rate=44100, block_size=441)
+  analyzer = audio_analysis.SpectrumAnalyzer(
+      a, fft_size=2048, hop_size=1024, bands=10)
+  analyzer.on('spectrum', _on_spectrum)
+  time.sleep(10)
+  a.stop()
+
+
+def _on_spectrum(analyzer, spectrum):
+  sys.stdout.write('\r' + ','.join(['{0:6.1f}'.format(x) for x in spectrum]))
+  sys.stdout.flush()
+
+
+def test_detectors():
+  a = audio.Audio(
+      name='C-Media USB Headphone Set.*', sample_rate=16000, block_size=320)
+  pipeline = audio_analysis.DetectorPipeline(a, [
+      audio_analysis.EnergyVad(16000),
+      audio_analysis.BandEnergyTrigger(16000, 2500, 3500, name='whistle'),
+      audio_analysis.OnsetDetector(16000),
+  ])
+  for event in ('voice_start', 'voice_stop', 'event'):
+    pipeline.on(event, _on_detection)
+  time.sleep(30)
+  a.stop()
+
+
+def _on_detection(pipeline, detection):
+  print('{0:.3f} {1} {2}'.format(detection.timestamp, detection.name,
+                                 detection.value))
+
+
 def _on_sample(a, data):
-  power = audio_util.create_power_spectrum(data)
+  power = audio_util.create_power_spectrum(data.tobytes())
   step = len(power) / 10
   power = power[::step]
   sys.stdout.write('\r' + ','.join([str(int(x)) for x in power]))
   sys.stdout.flush()
 
-  file.writeframes(data)
+  file.writeframes(data.tobytes())
 
 
 if __name__ == '__main__':
@@ -1,23 +1,22 @@
-import ctypes
 import datetime
 import enum
 import math
+import numpy as np
 import smbus
+import struct
 import time
 
+from hal import bmp180
+from hal import bmp180_compensation
 from hal.LSM9DS0 import *
 from common import pattern
 from common import unit
 
 
-# return two bytes from data as a signed 16-bit value
-def _get_short(data, index):
-  return ctypes.c_short((data[index] << 8) + data[index + 1]).value
-
-
-# return two bytes from data as an unsigned 16-bit value
-def _get_ushort(data, index):
-  return (data[index] << 8) + data[index + 1]
+def _read_acc_xyz(bus, sampler):
+  if sampler and sampler.ready:
+    return sampler.acc
+  return bus.read_acc_xyz()
 
 
 class _Axis(enum.Enum):
@@ -26,6 +25,109 @@ class _Axis(enum.Enum):
   Z = 2
 
 
+class AccDataRate(enum.Enum):
+  """Accelerometer output data rate: (AODR bits, Hz)."""
+  HZ_3_125 = (0b0001, 3.125)
+  HZ_6_25 = (0b0010, 6.25)
+  HZ_12_5 = (0b0011, 12.5)
+  HZ_25 = (0b0100, 25.0)
+  HZ_50 = (0b0101, 50.0)
+  HZ_100 = (0b0110, 100.0)
+  HZ_200 = (0b0111, 200.0)
+  HZ_400 = (0b1000, 400.0)
+  HZ_800 = (0b1001, 800.0)
+  HZ_1600 = (0b1010, 1600.0)
+
+  @property
+  def hz(self):
+    return self.value[1]
+
+
+class AccRange(enum.Enum):
+  """Accelerometer full scale: (AFS bits, mg/LSB)."""
+  G2 = (0b000, 0.061)
+  G4 = (0b001, 0.122)
+  G6 = (0b010, 0.183)
+  G8 = (0b011, 0.244)
+  G16 = (0b100, 0.732)
+
+  @property
+  def scale(self):
+    """Gets sensitivity in g/LSB."""
+    return self.value[1] / 1000
+
+
+class AccBandwidth(enum.Enum):
+  """Accelerometer anti-alias filter bandwidth (ABW bits)."""
+  HZ_773 = 0b00
+  HZ_194 = 0b01
+  HZ_362 = 0b10
+  HZ_50 = 0b11
+
+
+class MagDataRate(enum.Enum):
+  """Magnetometer output data rate: (M_ODR bits, Hz)."""
+  HZ_3_125 = (0b000, 3.125)
+  HZ_6_25 = (0b001, 6.25)
+  HZ_12_5 = (0b010, 12.5)
+  HZ_25 = (0b011, 25.0)
+  HZ_50 = (0b100, 50.0)
+  HZ_100 = (0b101, 100.0)
+
+  @property
+  def hz(self):
+    return self.value[1]
+
+
+class MagRange(enum.Enum):
+  """Magnetometer full scale: (MFS bits, mgauss/LSB)."""
+  GAUSS2 = (0b00, 0.08)
+  GAUSS4 = (0b01, 0.16)
+  GAUSS8 = (0b10, 0.32)
+  GAUSS12 = (0b11, 0.48)
+
+  @property
+  def scale(self):
+    """Gets sensitivity in gauss/LSB."""
+    return self.value[1] / 1000
+
+
+class GyroDataRate(enum.Enum):
+  """Gyroscope output data rate: (DR bits, Hz)."""
+  HZ_95 = (0b00, 95.0)
+  HZ_190 = (0b01, 190.0)
+  HZ_380 = (0b10, 380.0)
+  HZ_760 = (0b11, 760.0)
+
+  @property
+  def hz(self):
+    return self.value[1]
+
+
+class GyroBandwidth(enum.Enum):
+  """Gyroscope low-pass cutoff (BW bits).
+
+  Actual cutoff depends on data rate, e.g. 12.5-25Hz at 95Hz and 30-100Hz at
+  760Hz; see LSM9DS0 datasheet table 21.
+  """
+  LOWEST = 0b00
+  LOW = 0b01
+  HIGH = 0b10
+  HIGHEST = 0b11
+
+
+class GyroRange(enum.Enum):
+  """Gyroscope full scale: (FS bits, mdps/LSB)."""
+  DPS245 = (0b00, 8.75)
+  DPS500 = (0b01, 17.5)
+  DPS2000 = (0b10, 70.0)
+
+  @property
+  def scale(self):
+    """Gets sensitivity in degrees/sec/LSB."""
+    return self.value[1] / 1000
+
+
 class IMUBus(pattern.Singleton):
   ACC_REG_LOW = [OUT_X_L_A, OUT_Y_L_A, OUT_Z_L_A]
   ACC_REG_HIGH = [OUT_X_H_A, OUT_Y_H_A, OUT_Z_H_A]
@@ -34,24 +136,100 @@ class IMUBus(pattern.Singleton):
   GYRO_REG_LOW = [OUT_X_L_G, OUT_Y_L_G, OUT_Z_L_G]
   GYRO_REG_HIGH = [OUT_X_H_G, OUT_Y_H_G, OUT_Z_H_G]
 
-  def __init__(self, *args, **kwargs):
+  # Setting MSB of the sub-address enables register auto-increment, so all
+  # three axes (X_L, X_H, Y_L, Y_H, Z_L, Z_H) come back in one transaction.
+  _AUTO_INCREMENT = 0x80
+  _XYZ = struct.Struct('<3h')
+
+  FIFO_DEPTH = 32  # samples
+  _FIFO_EN = 0b01000000  # FIFO_EN bit of CTRL_REG0_XM and CTRL_REG5_G
+  _FIFO_MODE_BYPASS = 0b00000000
+  _FIFO_MODE_STREAM = 0b01000000
+  _FIFO_WATERMARK = 0b00011111
+  _FIFO_OVERRUN = 0b01000000
+  _FIFO_LEVEL = 0b00011111
+  # SMBus block reads are capped at 32 bytes, i.e. five 6-byte samples.
+  _FIFO_BLOCK_SAMPLES = 5
+
+  def __init__(self,
+               acc_rate=AccDataRate.HZ_100,
+               acc_range=AccRange.G16,
+               acc_bandwidth=AccBandwidth.HZ_773,
+               mag_rate=MagDataRate.HZ_50,
+               mag_range=MagRange.GAUSS12,
+               gyro_rate=GyroDataRate.HZ_95,
+               gyro_bandwidth=GyroBandwidth.LOWEST,
+               gyro_range=GyroRange.DPS2000,
+               *args,
+               **kwargs):
     super(IMUBus, self).__init__(*args, **kwargs)
     self._bus = smbus.SMBus(1)
-    self.write_acc(
-        CTRL_REG1_XM,
-        0b01100111)  #z,y,x axis enabled, continuos update,  100Hz data rate
-    self.write_acc(CTRL_REG2_XM, 0b00100000)  #+/- 16G full scale
+    self.configure(acc_rate, acc_range, acc_bandwidth, mag_rate, mag_range,
+                   gyro_rate, gyro_bandwidth, gyro_range)
+
+  @property
+  def bus(self):
+    """Gets underlying SMBus instance."""
+    return self._bus
+
+  @property
+  def acc_rate(self):
+    return self._acc_rate
+
+  @property
+  def mag_rate(self):
+    return self._mag_rate
+
+  @property
+  def gyro_rate(self):
+    return self._gyro_rate
+
+  @property
+  def acc_scale(self):
+    """Gets accelerometer sensitivity in g/LSB."""
+    return self._acc_scale
+
+  @property
+  def mag_scale(self):
+    """Gets magnetometer sensitivity in gauss/LSB."""
+    return self._mag_scale
+
+  @property
+  def gyro_scale(self):
+    """Gets gyroscope sensitivity in degrees/sec/LSB."""
+    return self._gyro_scale
+
+  def configure(self, acc_rate, acc_range, acc_bandwidth, mag_rate, mag_range,
+                gyro_rate, gyro_bandwidth, gyro_range):
+    """Writes data rate, bandwidth and full scale of all sensors.
+
+    Scale factors are cached, so raw readings convert with one multiply.
+    Objects that copy a scale factor at construction (e.g. Attitude) should
+    be created after configuring.
+    """
+    #z,y,x axis enabled, continuous update
+    self.write_acc(CTRL_REG1_XM, (acc_rate.value[0] << 4) | 0b0111)
+    self.write_acc(CTRL_REG2_XM,
+                   (acc_bandwidth.value << 6) | (acc_range.value[0] << 3))
 
     #initialise the magnetometer
-    self.write_mag(CTRL_REG5_XM, 0b11110000)  #Temp enable, M data rate = 50Hz
-    self.write_mag(CTRL_REG6_XM, 0b01100000)  #+/-12gauss
+    #Temp enable, high resolution
+    self.write_mag(CTRL_REG5_XM, 0b11100000 | (mag_rate.value[0] << 2))
+    self.write_mag(CTRL_REG6_XM, mag_range.value[0] << 5)
     self.write_mag(CTRL_REG7_XM, 0b00000000)  #Continuous-conversion mode
 
     #initialise the gyroscope
-    self.write_gyro(CTRL_REG1_G,
-                    0b00001111)  #Normal power mode, all axes enabled
-    self.write_gyro(CTRL_REG4_G,
-                    0b00110000)  #Continuos update, 2000 dps full scale
+    #Normal power mode, all axes enabled
+    self.write_gyro(CTRL_REG1_G, (gyro_rate.value[0] << 6) |
+                    (gyro_bandwidth.value << 4) | 0b1111)
+    self.write_gyro(CTRL_REG4_G, gyro_range.value[0] << 4)  #Continuous update
+
+    self._acc_rate = acc_rate
+    self._mag_rate = mag_rate
+    self._gyro_rate = gyro_rate
+    self._acc_scale = acc_range.scale
+    self._mag_scale = mag_range.scale
+    self._gyro_scale = gyro_range.scale
 
   def write_env(self, register, value):
     self._bus.write_byte_data(ENV_ADDRESS, register, value)
@@ -63,72 +241,315 @@ class IMUBus(pattern.Singleton):
     self._bus.write_byte_data(ACC_ADDRESS, register, value)
 
   def read_acc(self, axis):
-    return self._read(IMUBus.ACC_REG_LOW[axis.value],
+    return self._read(ACC_ADDRESS, IMUBus.ACC_REG_LOW[axis.value],
                       IMUBus.ACC_REG_HIGH[axis.value])
 
+  def read_acc_xyz(self):
+    """Reads all accelerometer axes in a single block transaction.
+
+    Returns:
+      (x, y, z) tuple of raw signed 16-bit readings.
+    """
+    return self._read_xyz(ACC_ADDRESS, OUT_X_L_A)
+
   def write_mag(self, register, value):
     self._bus.write_byte_data(MAG_ADDRESS, register, value)
 
   def read_mag(self, axis):
-    return self._read(IMUBus.MAG_REG_LOW[axis.value],
+    return self._read(MAG_ADDRESS, IMUBus.MAG_REG_LOW[axis.value],
                       IMUBus.MAG_REG_HIGH[axis.value])
 
+  def read_mag_xyz(self):
+    """Reads all magnetometer axes in a single block transaction.
+
+    Returns:
+      (x, y, z) tuple of raw signed 16-bit readings.
+    """
+    return self._read_xyz(MAG_ADDRESS, OUT_X_L_M)
+
   def write_gyro(self, register, value):
     self._bus.write_byte_data(GYR_ADDRESS, register, value)
 
   def read_gyro(self, axis):
-    return self._read(IMUBus.GYRO_REG_LOW[axis.value],
+    return self._read(GYR_ADDRESS, IMUBus.GYRO_REG_LOW[axis.value],
                       IMUBus.GYRO_REG_HIGH[axis.value])
 
-  def _read(self, low, high):
-    acc_l = self._bus.read_byte_data(ACC_ADDRESS, low)
-    acc_h = self._bus.read_byte_data(ACC_ADDRESS, high)
+  def read_gyro_xyz(self):
+    """Reads all gyroscope axes in a single block transaction.
+
+    Returns:
+      (x, y, z) tuple of raw signed 16-bit readings.
+    """
+    return self._read_xyz(GYR_ADDRESS, OUT_X_L_G)
+
+  def enable_fifo(self, watermark=16):
+    """Enables accelerometer and gyroscope FIFOs in stream mode.
+
+    In stream mode the chip keeps the latest FIFO_DEPTH samples per sensor,
+    which can then be fetched with drain_acc_fifo() and drain_gyro_fifo().
+
+    Args:
+      watermark: FIFO level (0-31) that raises the watermark flag.
+    """
+    mode = IMUBus._FIFO_MODE_STREAM | (watermark & IMUBus._FIFO_WATERMARK)
+    self._update(ACC_ADDRESS, CTRL_REG0_XM, IMUBus._FIFO_EN, IMUBus._FIFO_EN)
+    self.write_acc(FIFO_CTRL_REG, mode)
+    self._update(GYR_ADDRESS, CTRL_REG5_G, IMUBus._FIFO_EN, IMUBus._FIFO_EN)
+    self.write_gyro(FIFO_CTRL_REG_G, mode)
+
+  def disable_fifo(self):
+    self.write_acc(FIFO_CTRL_REG, IMUBus._FIFO_MODE_BYPASS)
+    self._update(ACC_ADDRESS, CTRL_REG0_XM, IMUBus._FIFO_EN, 0)
+    self.write_gyro(FIFO_CTRL_REG_G, IMUBus._FIFO_MODE_BYPASS)
+    self._update(GYR_ADDRESS, CTRL_REG5_G, IMUBus._FIFO_EN, 0)
+
+  def acc_fifo_level(self):
+    """Gets number of samples pending in accelerometer FIFO."""
+    return self._fifo_level(ACC_ADDRESS, FIFO_SRC_REG)
+
+  def gyro_fifo_level(self):
+    """Gets number of samples pending in gyroscope FIFO."""
+    return self._fifo_level(GYR_ADDRESS, FIFO_SRC_REG_G)
+
+  def drain_acc_fifo(self):
+    """Reads all samples pending in accelerometer FIFO.
+
+    Returns:
+      (n, 3) int16 numpy array of raw (x, y, z) readings, oldest first.
+    """
+    return self._drain_fifo(ACC_ADDRESS, FIFO_SRC_REG, OUT_X_L_A)
+
+  def drain_gyro_fifo(self):
+    """Reads all samples pending in gyroscope FIFO.
+
+    Returns:
+      (n, 3) int16 numpy array of raw (x, y, z) readings, oldest first.
+    """
+    return self._drain_fifo(GYR_ADDRESS, FIFO_SRC_REG_G, OUT_X_L_G)
+
+  def _fifo_level(self, address, register):
+    src = self._bus.read_byte_data(address, register)
+    if src & IMUBus._FIFO_OVERRUN:
+      return IMUBus.FIFO_DEPTH
+    return src & IMUBus._FIFO_LEVEL
+
+  def _drain_fifo(self, address, src_register, out_register):
+    # With FIFO enabled, auto-increment wraps from OUT_Z_H back to OUT_X_L,
+    # so consecutive samples can be fetched in one block read.
+    remaining = self._fifo_level(address, src_register)
+    data = bytearray()
+    while remaining:
+      count = min(remaining, IMUBus._FIFO_BLOCK_SAMPLES)
+      data.extend(
+          self._bus.read_i2c_block_data(
+              address, out_register | IMUBus._AUTO_INCREMENT, count * 6))
+      remaining -= count
+    return np.frombuffer(data, dtype='<i2').reshape(-1, 3)
+
+  def _update(self, address, register, mask, value):
+    current = self._bus.read_byte_data(address, register)
+    self._bus.write_byte_data(address, register, (current & ~mask) | value)
+
+  def _read(self, address, low, high):
+    acc_l = self._bus.read_byte_data(address, low)
+    acc_h = self._bus.read_byte_data(address, high)
     acc_combined = (acc_l | acc_h << 8)
     return acc_combined if acc_combined < 32768 else acc_combined - 65536
 
+  def _read_xyz(self, address, register):
+    data = self._bus.read_i2c_block_data(address,
+                                         register | IMUBus._AUTO_INCREMENT, 6)
+    return IMUBus._XYZ.unpack(bytearray(data))
+
+
+class SampleRing(object):
+  """Preallocated ring buffer of timestamped raw IMU samples.
+
+  Each row holds accelerometer, gyroscope and magnetometer X/Y/Z readings as
+  raw signed 16-bit values, in that order. Only the writer thread appends;
+  readers may fetch the latest row or a range of rows at any time.
+  """
+
+  ACC = slice(0, 3)
+  GYRO = slice(3, 6)
+  MAG = slice(6, 9)
+
+  def __init__(self, capacity):
+    self._capacity = capacity
+    self._timestamps = np.zeros(capacity, dtype=np.float64)
+    self._values = np.zeros((capacity, 9), dtype=np.int16)
+    self._count = 0
+
+  @property
+  def capacity(self):
+    return self._capacity
+
+  @property
+  def count(self):
+    """Gets total number of samples ever appended."""
+    return self._count
+
+  def append(self, timestamp, acc, gyro, mag):
+    i = self._count % self._capacity
+    self._timestamps[i] = timestamp
+    row = self._values[i]
+    row[SampleRing.ACC] = acc
+    row[SampleRing.GYRO] = gyro
+    row[SampleRing.MAG] = mag
+    self._count += 1
+
+  def latest(self):
+    """Gets most recent sample.
+
+    Returns:
+      (timestamp, values) where values is a 9-element int16 array, or None if
+      nothing has been appended yet.
+    """
+    count = self._count
+    if not count:
+      return None
+    i = (count - 1) % self._capacity
+    return (self._timestamps[i], self._values[i].copy())
+
+  def read(self, start):
+    """Gets copies of all samples appended since given sample count.
+
+    Samples that have already been overwritten are skipped.
+
+    Args:
+      start: value of count from a previous read.
+    Returns:
+      (timestamps, values) arrays with shapes (n,) and (n, 9).
+    """
+    end = self._count
+    start = max(start, end - self._capacity)
+    indices = np.arange(start, end) % self._capacity
+    return (self._timestamps[indices], self._values[indices])
+
+
+class IMUSampler(pattern.Worker, pattern.EventEmitter):
+  """Samples accelerometer, gyroscope and magnetometer at a fixed rate.
+
+  Readings are stored in a SampleRing, so consumers can fetch the latest
+  sample without touching the bus.
+
+  Events:
+    "samples": triggered every batch_size samples.
+      sampler (IMUSampler)
+      timestamps (numpy.ndarray): monotonic time of each sample, in seconds.
+      values (numpy.ndarray): (n, 9) raw readings, see SampleRing.
+  """
+
+  def __init__(self, rate=100, batch_size=10, capacity=1024, *args, **kwargs):
+    super(IMUSampler, self).__init__(worker_name='IMUSampler', *args, **kwargs)
+    self._bus = IMUBus.get_instance()
+    self._interval = 1.0 / rate
+    self._batch_size = batch_size
+    self._ring = SampleRing(capacity)
+    self._emitted = 0
+    self._next = None
+
+  @property
+  def rate(self):
+    return 1.0 / self._interval
+
+  @property
+  def ring(self):
+    return self._ring
+
+  @property
+  def ready(self):
+    return self._ring.count > 0
+
+  @property
+  def timestamp(self):
+    """Gets monotonic time of the latest sample, or None before the first."""
+    latest = self._ring.latest()
+    return latest[0] if latest else None
+
+  @property
+  def acc(self):
+    """Gets latest raw accelerometer (x, y, z), or None before the first."""
+    return self._latest_axes(SampleRing.ACC)
+
+  @property
+  def gyro(self):
+    """Gets latest raw gyroscope (x, y, z), or None before the first."""
+    return self._latest_axes(SampleRing.GYRO)
+
+  @property
+  def mag(self):
+    """Gets latest raw magnetometer (x, y, z), or None before the first."""
+    return self._latest_axes(SampleRing.MAG)
+
+  def _latest_axes(self, axes):
+    latest = self._ring.latest()
+    return tuple(latest[1][axes].tolist()) if latest else None
+
+  def _on_start(self):
+    self._emitted = self._ring.count
+    self._next = time.monotonic()
+
+  def _on_run(self):
+    delay = self._next - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+
+    timestamp = time.monotonic()
+    self._ring.append(timestamp, self._bus.read_acc_xyz(),
+                      self._bus.read_gyro_xyz(), self._bus.read_mag_xyz())
+
+    # Keep a steady cadence, but don't burst to catch up after a stall.
+    self._next += self._interval
+    if self._next < timestamp:
+      self._next = timestamp + self._interval
+
+    if self._ring.count - self._emitted >= self._batch_size:
+      if self.emittable('samples'):
+        timestamps, values = self._ring.read(self._emitted)
+        self.emit('samples', self, timestamps, values)
+      self._emitted = self._ring.count
+
 
 class Load(object):
 
-  def __init__(self):
+  def __init__(self, sampler=None):
+    """
+    Args:
+      sampler: optional IMUSampler. If given, readings come from its latest
+        sample instead of the bus.
+    """
     self._bus = IMUBus.get_instance()
+    self._sampler = sampler
 
   @property
   def x(self):
-    value = self._bus.read_acc(_Axis.X)
-    return value * 0.732 / 1000
+    return self.xyz[0]
 
   @property
   def y(self):
-    value = self._bus.read_acc(_Axis.Y)
-    return value * 0.732 / 1000
+    return self.xyz[1]
 
   @property
   def z(self):
-    value = self._bus.read_acc(_Axis.Z)
-    return value * 0.732 / 1000
+    return self.xyz[2]
+
+  @property
+  def xyz(self):
+    """Gets G load on all three axes from a single bus read."""
+    x, y, z = _read_acc_xyz(self._bus, self._sampler)
+    scale = self._bus.acc_scale
+    return (x * scale, y * scale, z * scale)
 
 
 class Environment(object):
 
-  _OVERSAMPLING = 3
+  _OVERSAMPLING = bmp180.Oversampling.ULTRA_HIGH_RESOLUTION
 
   def __init__(self):
     self._bus = IMUBus.get_instance()
-
-    # Read whole calibration EEPROM data
-    cal = self._bus.read_env(0xAA, 22)
-    # Convert byte data to word values
-    self._ac1 = _get_short(cal, 0)
-    self._ac2 = _get_short(cal, 2)
-    self._ac3 = _get_short(cal, 4)
-    self._ac4 = _get_ushort(cal, 6)
-    self._ac5 = _get_ushort(cal, 8)
-    self._ac6 = _get_ushort(cal, 10)
-    self._b1 = _get_short(cal, 12)
-    self._b2 = _get_short(cal, 14)
-    self._mb = _get_short(cal, 16)
-    self._mc = _get_short(cal, 18)
-    self._md = _get_short(cal, 20)
+    self._calibration = bmp180_compensation.read_calibration(
+        self._bus.bus, ENV_ADDRESS)
 
   @property
   def temperature(self):
@@ -152,332 +573,310 @@ class Environment(object):
   def _update(self):
     # Get raw temperature
     self._bus.write_env(0xF4, 0x2E)
-    time.sleep(0.005)
-    (msb, lsb) = self._bus.read_env(0xF6, 2)
-    ut = (msb << 8) + lsb
-
-    # Calculating temperature
-    x1 = ((ut - self._ac6) * self._ac5) >> 15
-    x2 = (self._mc << 11) / (x1 + self._md)
-    b5 = x1 + x2
-    t = (b5 + 8) >> 4
+    time.sleep(bmp180.TEMPERATURE_CONVERSION_TIME)
+    ut = bmp180_compensation.raw_temperature(self._bus.read_env(0xF6, 2))
 
     # Get raw pressure
-    self._bus.write_env(0xF4, 0x34 + (Environment._OVERSAMPLING << 6))
-    time.sleep(0.04)
-    (msb, lsb, xsb) = self._bus.read_env(0xF6, 3)
-    up = ((msb << 16) + (lsb << 8) + xsb) >> (8 - Environment._OVERSAMPLING)
-
-    # Calculating pressure
-    b6 = b5 - 4000
-    b62 = b6 * b6 >> 12
-    x1 = (self._b2 * b62) >> 11
-    x2 = self._ac2 * b6 >> 11
-    x3 = x1 + x2
-    b3 = (((self._ac1 * 4 + x3) << Environment._OVERSAMPLING) + 2) >> 2
-
-    x1 = self._ac3 * b6 >> 13
-    x2 = (self._b1 * b62) >> 16
-    x3 = ((x1 + x2) + 2) >> 2
-    b4 = (self._ac4 * (x3 + 32768)) >> 15
-    b7 = (up - b3) * (50000 >> Environment._OVERSAMPLING)
-
-    p = (b7 * 2) / b4
-    #p = (b7 / b4) * 2
-
-    x1 = (p >> 8) * (p >> 8)
-    x1 = (x1 * 3038) >> 16
-    x2 = (-7357 * p) >> 16
-    p = p + ((x1 + x2 + 3791) >> 4)
+    oss = Environment._OVERSAMPLING.oss
+    self._bus.write_env(0xF4, 0x34 + (oss << 6))
+    time.sleep(Environment._OVERSAMPLING.conversion_time)
+    up = bmp180_compensation.raw_pressure(self._bus.read_env(0xF6, 3), oss)
 
+    t, p = bmp180_compensation.compensate(self._calibration, ut, up, oss)
     self._temperature = unit.Temperature(t / 10.0, unit.Temperature.CELSIUS)
     self._pressure = unit.Pressure(p, unit.Pressure.PA)
 
 
-class Attitude(object):
+class FusionMode(enum.Enum):
+  KALMAN = 1
+  COMPLEMENTARY = 2
+
+
+class KalmanFilter(object):
+  """One-axis Kalman filter fusing an absolute angle with an angular rate.
+
+  The state is the angle and the gyro bias; angles are in degrees.
+  """
+
+  __slots__ = ('angle', 'bias', '_p00', '_p01', '_p10', '_p11', '_q_angle',
+               '_q_gyro', '_r_angle')
+
+  def __init__(self, angle=0.0, q_angle=0.02, q_gyro=0.0015, r_angle=0.005):
+    self.angle = angle
+    self.bias = 0.0
+    self._p00 = 0.0
+    self._p01 = 0.0
+    self._p10 = 0.0
+    self._p11 = 0.0
+    self._q_angle = q_angle
+    self._q_gyro = q_gyro
+    self._r_angle = r_angle
+
+  def update(self, angle, rate, dt):
+    """Advances the filter by one step.
+
+    Args:
+      angle: measured angle (e.g. from accelerometer), in degrees.
+      rate: measured angular rate (e.g. from gyro), in degrees/sec.
+      dt: time since previous step, in seconds.
+    Returns:
+      Filtered angle, in degrees.
+    """
+    self.angle += dt * (rate - self.bias)
+
+    self._p00 += -dt * (self._p10 + self._p01) + self._q_angle * dt
+    self._p01 -= dt * self._p11
+    self._p10 -= dt * self._p11
+    self._p11 += self._q_gyro * dt
+
+    y = angle - self.angle
+    s = self._p00 + self._r_angle
+    k0 = self._p00 / s
+    k1 = self._p10 / s
+
+    self.angle += k0 * y
+    self.bias += k1 * y
+
+    p00 = self._p00
+    p01 = self._p01
+    self._p00 -= k0 * p00
+    self._p01 -= k0 * p01
+    self._p10 -= k1 * p00
+    self._p11 -= k1 * p01
+    return self.angle
+
+  def run(self, angles, rates, dts, out):
+    """Runs the filter over a sequence of measurements.
+
+    Equivalent to calling update() for each element, but keeps the state in
+    local variables for the duration of the loop.
+
+    Args:
+      angles, rates, dts: sequences of equal length, see update().
+      out: numpy array to receive filtered angles.
+    """
+    x, bias = self.angle, self.bias
+    p00, p01, p10, p11 = self._p00, self._p01, self._p10, self._p11
+    q_angle, q_gyro, r_angle = self._q_angle, self._q_gyro, self._r_angle
+    for i, (angle, rate, dt) in enumerate(zip(angles, rates, dts)):
+      x += dt * (rate - bias)
+      p00 += -dt * (p10 + p01) + q_angle * dt
+      p01 -= dt * p11
+      p10 -= dt * p11
+      p11 += q_gyro * dt
+      y = angle - x
+      s = p00 + r_angle
+      k0 = p00 / s
+      k1 = p10 / s
+      x += k0 * y
+      bias += k1 * y
+      p00, p01, p10, p11 = (p00 - k0 * p00, p01 - k0 * p01, p10 - k1 * p00,
+                            p11 - k1 * p01)
+      out[i] = x
+    self.angle, self.bias = x, bias
+    self._p00, self._p01, self._p10, self._p11 = p00, p01, p10, p11
+
+
+class ComplementaryFilter(object):
+  """One-axis complementary filter; angles are in degrees."""
+
+  __slots__ = ('angle', '_alpha')
+
+  def __init__(self, angle=0.0, alpha=0.40):
+    self.angle = angle
+    self._alpha = alpha
+
+  def update(self, angle, rate, dt):
+    self.angle = (self._alpha * (self.angle + rate * dt) +
+                  (1 - self._alpha) * angle)
+    return self.angle
+
+  def run(self, angles, rates, dts, out):
+    x = self.angle
+    a = self._alpha
+    b = 1 - a
+    for i, (angle, rate, dt) in enumerate(zip(angles, rates, dts)):
+      x = a * (x + rate * dt) + b * angle
+      out[i] = x
+    self.angle = x
+
+
+class AttitudeFilter(object):
+  """Fuses raw gyro, accelerometer and magnetometer readings into attitude.
+
+  Pitch and roll come from per-axis filters combining accelerometer angles
+  with gyro rates; heading is tilt compensated using the filtered pitch and
+  roll. All state is per instance, so several IMUs can be filtered at once.
+  All angles are in degrees.
+  """
+
+  __slots__ = ('_gyro_gain', '_pitch_filter', '_roll_filter', '_timestamp',
+               'pitch', 'roll', 'heading')
+
+  def __init__(self,
+               mode=FusionMode.KALMAN,
+               gyro_gain=GyroRange.DPS2000.scale):
+    """
+    Args:
+      mode: FusionMode to combine accelerometer and gyro.
+      gyro_gain: gyro sensitivity in degrees/sec/LSB, see IMUBus.gyro_scale.
+    """
+    self._gyro_gain = gyro_gain
+    if mode == FusionMode.KALMAN:
+      self._pitch_filter = KalmanFilter()
+      self._roll_filter = KalmanFilter()
+    else:
+      self._pitch_filter = ComplementaryFilter()
+      self._roll_filter = ComplementaryFilter()
+    self._timestamp = None
+    self.pitch = 0.0
+    self.roll = 0.0
+    self.heading = 0.0
+
+  @property
+  def timestamp(self):
+    """Gets timestamp of the last sample filtered."""
+    return self._timestamp
+
+  def update(self, timestamp, acc, gyro, mag):
+    """Filters one sample.
+
+    Args:
+      timestamp: sample time in seconds.
+      acc, gyro, mag: raw (x, y, z) readings.
+    Returns:
+      (pitch, roll, heading) in degrees.
+    """
+    ax, ay, az = acc
+    acc_pitch = math.degrees(math.atan2(ax, az))
+    acc_roll = -math.degrees(math.atan2(ay, az))
+    if self._timestamp is None:
+      self._pitch_filter.angle = acc_pitch
+      self._roll_filter.angle = acc_roll
+      dt = 0.0
+    else:
+      dt = timestamp - self._timestamp
+    self._timestamp = timestamp
+
+    self.pitch = self._pitch_filter.update(acc_pitch,
+                                           -gyro[1] * self._gyro_gain, dt)
+    self.roll = self._roll_filter.update(acc_roll, -gyro[0] * self._gyro_gain,
+                                         dt)
+    self.heading = float(
+        _tilt_compensated_heading(mag[0], mag[1], mag[2],
+                                  math.radians(self.pitch),
+                                  math.radians(self.roll)))
+    return (self.pitch, self.roll, self.heading)
+
+  def filter(self, timestamps, values):
+    """Filters a batch of samples, e.g. from SampleRing.read().
+
+    Angle, rate and heading math is vectorized; only the filter recursion
+    itself runs per sample.
+
+    Args:
+      timestamps: (n,) array of sample times in seconds.
+      values: (n, 9) array of raw readings, laid out as in SampleRing.
+    Returns:
+      (n, 3) float64 array of (pitch, roll, heading) in degrees.
+    """
+    n = len(timestamps)
+    result = np.empty((n, 3))
+    if not n:
+      return result
+
+    values = np.asarray(values, dtype=np.float64)
+    ax, ay, az = values[:, 0], values[:, 1], values[:, 2]
+    acc_pitch = np.degrees(np.arctan2(ax, az))
+    acc_roll = -np.degrees(np.arctan2(ay, az))
+    pitch_rate = values[:, 4] * -self._gyro_gain
+    roll_rate = values[:, 3] * -self._gyro_gain
+
+    if self._timestamp is None:
+      self._pitch_filter.angle = acc_pitch[0]
+      self._roll_filter.angle = acc_roll[0]
+      dt = np.diff(timestamps, prepend=timestamps[0])
+    else:
+      dt = np.diff(timestamps, prepend=self._timestamp)
+    self._timestamp = timestamps[-1]
+
+    self._pitch_filter.run(acc_pitch.tolist(), pitch_rate.tolist(),
+                           dt.tolist(), result[:, 0])
+    self._roll_filter.run(acc_roll.tolist(), roll_rate.tolist(), dt.tolist(),
+                          result[:, 1])
+    result[:, 2] = _tilt_compensated_heading(
+        values[:, 6], values[:, 7], values[:, 8], np.radians(result[:, 0]),
+        np.radians(result[:, 1]))
+
+    self.pitch, self.roll, self.heading = result[-1].tolist()
+    return result
+
+
+def _tilt_compensated_heading(mx, my, mz, pitch, roll):
+  """Computes heading in degrees [0, 360) from magnetometer and attitude.
+
+  Works on scalars as well as numpy arrays. Pitch and roll are in radians.
+  """
+  sin_pitch = np.sin(pitch)
+  cos_pitch = np.cos(pitch)
+  sin_roll = np.sin(roll)
+  x = mx * cos_pitch + mz * sin_pitch
+  y = mx * sin_roll * sin_pitch + my * np.cos(roll) - mz * sin_roll * cos_pitch
+  return np.degrees(np.arctan2(y, x)) % 360
 
-  def __init__(self):
-    self._bus = IMUBus.get_instance()
 
-    self._gyroXangle = 0.0
-    self._gyroYangle = 0.0
-    self._gyroZangle = 0.0
-    self._CFangleX = 0.0
-    self._CFangleY = 0.0
+class Attitude(object):
+  """Pitch, roll and tilt compensated heading from the IMU.
+
+  Without a sampler, property accesses read the bus and advance the fusion
+  filter at most once per sample interval of the sensors, so reading all
+  three angles costs one set of reads. With an IMUSampler, the filter runs
+  over each batch of samples as it arrives and properties return the latest
+  result.
+  """
+
+  def __init__(self, sampler=None, mode=FusionMode.KALMAN):
+    """
+    Args:
+      sampler: optional IMUSampler to take readings from instead of the bus.
+      mode: FusionMode to combine accelerometer and gyro.
+    """
+    self._bus = IMUBus.get_instance()
+    self._sampler = sampler
+    self._filter = AttitudeFilter(mode=mode, gyro_gain=self._bus.gyro_scale)
+    # New data is only available once per period of the slower sensor.
+    self._interval = 1.0 / min(self._bus.acc_rate.hz, self._bus.gyro_rate.hz)
+    self._next_update = 0
+    if sampler:
+      sampler.on('samples', self._on_samples)
 
   @property
   def pitch(self):
-    #Read the accelerometer,gyroscope and magnetometer values
-    ACCx = self._bus.read_acc(_Axis.X)
-    ACCy = self._bus.read_acc(_Axis.Y)
-    ACCz = self._bus.read_acc(_Axis.Z)
-
-    #Normalize accelerometer raw values.
-    accXnorm = ACCx / math.sqrt(ACCx * ACCx + ACCy * ACCy + ACCz * ACCz)
-
-    ####################################################################
-    ###################Calculate pitch and roll#########################
-    ####################################################################
-    #Use these two lines when the IMU is up the right way. Skull logo is facing down
-    pitch = math.asin(accXnorm)
-    #
-    #Us these four lines when the IMU is upside down. Skull logo is facing up
-    #accXnorm = -accXnorm               #flip Xnorm as the IMU is upside down
-    #pitch = math.asin(accXnorm)
-    #
-    ############################ END ##################################
-    return unit.Angle(pitch, unit.Angle.RADIAN, unit.Angle.RELATIVE_RANGE)
+    self._update()
+    return unit.Angle(self._filter.pitch, unit.Angle.DEGREE,
+                      unit.Angle.RELATIVE_RANGE)
 
   @property
   def roll(self):
-    #Read the accelerometer,gyroscope and magnetometer values
-    ACCx = self._bus.read_acc(_Axis.X)
-    ACCy = self._bus.read_acc(_Axis.Y)
-    ACCz = self._bus.read_acc(_Axis.Z)
-
-    #Normalize accelerometer raw values.
-    accXnorm = ACCx / math.sqrt(ACCx * ACCx + ACCy * ACCy + ACCz * ACCz)
-    accYnorm = ACCy / math.sqrt(ACCx * ACCx + ACCy * ACCy + ACCz * ACCz)
-
-    ####################################################################
-    ###################Calculate pitch and roll#########################
-    ####################################################################
-    #Use these two lines when the IMU is up the right way. Skull logo is facing down
-    pitch = math.asin(accXnorm)
-    roll = -math.asin(accYnorm / math.cos(pitch))
-    #
-    #Us these four lines when the IMU is upside down. Skull logo is facing up
-    #accXnorm = -accXnorm               #flip Xnorm as the IMU is upside down
-    #accYnorm = -accYnorm               #flip Ynorm as the IMU is upside down
-    #pitch = math.asin(accXnorm)
-    #roll = math.asin(accYnorm/math.cos(pitch))
-    #
-    ############################ END ##################################
-    return unit.Angle(roll, unit.Angle.RADIAN, unit.Angle.RELATIVE_RANGE)
+    self._update()
+    return unit.Angle(self._filter.roll, unit.Angle.DEGREE,
+                      unit.Angle.RELATIVE_RANGE)
 
   @property
   def heading(self):
-    MAGx = self._bus.read_mag(_Axis.X)
-    MAGy = self._bus.read_mag(_Axis.Y)
-    ####################################################################
-    ############################MAG direction ##########################
-    ####################################################################
-    #If IMU is upside down, then use this line.  It isnt needed if the
-    # IMU is the correct way up
-    #MAGy = -MAGy
-    #
-    ############################ END ##################################
-
-    #Calculate heading
-    heading = math.atan2(MAGy, MAGx)
-    return unit.Angle(heading, unit.Angle.RADIAN, unit.Angle.HEADING_RANGE)
-
-  '''
-RAD_TO_DEG = 57.29578
-M_PI = 3.14159265358979323846
-G_GAIN = 0.070  # [deg/s/LSB]  If you change the dps for gyro, you need to update this value accordingly
-AA =  0.40      # Complementary filter constant
-
-#Kalman filter variables
-Q_angle = 0.02
-Q_gyro = 0.0015
-R_angle = 0.005
-y_bias = 0.0
-x_bias = 0.0
-XP_00 = 0.0
-XP_01 = 0.0
-XP_10 = 0.0
-XP_11 = 0.0
-YP_00 = 0.0
-YP_01 = 0.0
-YP_10 = 0.0
-YP_11 = 0.0
-KFangleX = 0.0
-KFangleY = 0.0
-
-
-def _kalmanFilterY(accAngle, gyroRate, DT):
-    y=0.0
-    S=0.0
-
-    global KFangleY
-    global Q_angle
-    global Q_gyro
-    global y_bias
-    global YP_00
-    global YP_01
-    global YP_10
-    global YP_11
-
-    KFangleY = KFangleY + DT * (gyroRate - y_bias)
-
-    YP_00 = YP_00 + ( - DT * (YP_10 + YP_01) + Q_angle * DT )
-    YP_01 = YP_01 + ( - DT * YP_11 )
-    YP_10 = YP_10 + ( - DT * YP_11 )
-    YP_11 = YP_11 + ( + Q_gyro * DT )
-
-    y = accAngle - KFangleY
-    S = YP_00 + R_angle
-    K_0 = YP_00 / S
-    K_1 = YP_10 / S
-
-    KFangleY = KFangleY + ( K_0 * y )
-    y_bias = y_bias + ( K_1 * y )
-
-    YP_00 = YP_00 - ( K_0 * YP_00 )
-    YP_01 = YP_01 - ( K_0 * YP_01 )
-    YP_10 = YP_10 - ( K_1 * YP_00 )
-    YP_11 = YP_11 - ( K_1 * YP_01 )
-
-    return KFangleY
-
-def _kalmanFilterX(accAngle, gyroRate, DT):
-    x=0.0
-    S=0.0
-
-    global KFangleX
-    global Q_angle
-    global Q_gyro
-    global x_bias
-    global XP_00
-    global XP_01
-    global XP_10
-    global XP_11
-
-
-    KFangleX = KFangleX + DT * (gyroRate - x_bias)
-
-    XP_00 = XP_00 + ( - DT * (XP_10 + XP_01) + Q_angle * DT )
-    XP_01 = XP_01 + ( - DT * XP_11 )
-    XP_10 = XP_10 + ( - DT * XP_11 )
-    XP_11 = XP_11 + ( + Q_gyro * DT )
-
-    x = accAngle - KFangleX
-    S = XP_00 + R_angle
-    K_0 = XP_00 / S
-    K_1 = XP_10 / S
-
-    KFangleX = KFangleX + ( K_0 * x )
-    x_bias = x_bias + ( K_1 * x )
-
-    XP_00 = XP_00 - ( K_0 * XP_00 )
-    XP_01 = XP_01 - ( K_0 * XP_01 )
-    XP_10 = XP_10 - ( K_1 * XP_00 )
-    XP_11 = XP_11 - ( K_1 * XP_01 )
-
-    return KFangleX
-
-    def _on_start(self):
-        self._a = time.time()
-
-    def _on_run(self):
-        #Read the accelerometer,gyroscope and magnetometer values
-        ACCx = readACCx()
-        ACCy = readACCy()
-        ACCz = readACCz()
-        GYRx = readGYRx()
-        GYRy = readGYRy()
-        GYRz = readGYRz()
-        MAGx = readMAGx()
-        MAGy = readMAGy()
-        MAGz = readMAGz()
-
-        ####################################################################
-        ############################MAG direction ##########################
-        ####################################################################
-        #If IMU is upside down, then use this line.  It isnt needed if the
-        # IMU is the correct way up
-        #MAGy = -MAGy
-        #
-        ############################ END ##################################
-
-        #Normalize accelerometer raw values.
-        accXnorm = ACCx/math.sqrt(ACCx * ACCx + ACCy * ACCy + ACCz * ACCz)
-        accYnorm = ACCy/math.sqrt(ACCx * ACCx + ACCy * ACCy + ACCz * ACCz)
-
-        ####################################################################
-        ###################Calculate pitch and roll#########################
-        ####################################################################
-        #Use these two lines when the IMU is up the right way. Skull logo is facing down
-        pitch = math.asin(accXnorm)
-        roll = -math.asin(accYnorm/math.cos(pitch))
-        #
-        #Us these four lines when the IMU is upside down. Skull logo is facing up
-        #accXnorm = -accXnorm               #flip Xnorm as the IMU is upside down
-        #accYnorm = -accYnorm               #flip Ynorm as the IMU is upside down
-        #pitch = math.asin(accXnorm)
-        #roll = math.asin(accYnorm/math.cos(pitch))
-        #
-        ############################ END ##################################
-
-        #Calculate heading
-        heading = 180 * math.atan2(MAGy,MAGx)/M_PI
-        #Only have our heading between 0 and 360
-        if heading < 0:
-            heading += 360
-
-        #Calculate the new tilt compensated values
-        magXcomp = MAGx*math.cos(pitch)+MAGz*math.sin(pitch)
-        magYcomp = MAGx*math.sin(roll)*math.sin(pitch)+MAGy*math.cos(roll)-MAGz*math.sin(roll)*math.cos(pitch)
-
-        #Calculate tilt compensated heading
-        tiltCompensatedHeading = 180 * math.atan2(magYcomp,magXcomp)/M_PI
-        if tiltCompensatedHeading < 0:
-                tiltCompensatedHeading += 360
-
-        #Convert Gyro raw to degrees per second
-        rate_gyr_x =  GYRx * G_GAIN
-        rate_gyr_y =  GYRy * G_GAIN
-        rate_gyr_z =  GYRz * G_GAIN
-
-        ##Calculate loop Period(LP). How long between Gyro Reads
-        now = time.time()
-        LP = (now - self._a) * 1000.0
-        self._a = now
-
-        #Calculate the angles from the gyro.
-        self._gyroXangle += rate_gyr_x*LP
-        self._gyroYangle += rate_gyr_y*LP
-        self._gyroZangle += rate_gyr_z*LP
-
-        ##Convert Accelerometer values to degrees
-        AccXangle =  (math.atan2(ACCy,ACCz)+M_PI)*RAD_TO_DEG
-        AccYangle =  (math.atan2(ACCz,ACCx)+M_PI)*RAD_TO_DEG
-
-        ####################################################################
-        ######################Correct rotation value########################
-        ####################################################################
-        #Change the rotation value of the accelerometer to -/+ 180 and
-            #move the Y axis '0' point to up.
-            #
-            #Two different pieces of code are used depending on how your IMU is mounted.
-        #If IMU is up the correct way, Skull logo is facing down, Use these lines
-        AccXangle -= 180.0
-        if AccYangle > 90:
-            AccYangle -= 270.0
-        else:
-            AccYangle += 90.0
-        #
-        #
-        #If IMU is upside down E.g Skull logo is facing up;
-        #if AccXangle >180:
-            #        AccXangle -= 360.0
-        #AccYangle-=90
-        #if (AccYangle >180):
-            #        AccYangle -= 360.0
-        ############################ END ##################################
-
-        #Complementary filter used to combine the accelerometer and gyro values.
-        self._CFangleX=AA*(self._CFangleX+rate_gyr_x*LP) +(1 - AA) * AccXangle
-        self._CFangleY=AA*(self._CFangleY+rate_gyr_y*LP) +(1 - AA) * AccYangle
-
-        #Kalman filter used to combine the accelerometer and gyro values.
-        kalmanY = kalmanFilterY(AccYangle, rate_gyr_y,LP)
-        kalmanX = kalmanFilterX(AccXangle, rate_gyr_x,LP)
-
-        self._pitch = pitch
-        self._roll = roll
-        self._heading = heading
-
-        time.sleep(0.03)
-    '''
+    self._update()
+    return unit.Angle(self._filter.heading, unit.Angle.DEGREE,
+                      unit.Angle.HEADING_RANGE)
+
+  def _update(self):
+    if self._sampler:
+      return
+    now = time.monotonic()
+    if now < self._next_update:
+      return
+    self._next_update = now + self._interval
+    self._filter.update(now, self._bus.read_acc_xyz(),
+                        self._bus.read_gyro_xyz(), self._bus.read_mag_xyz())
+
+  def _on_samples(self, sampler, timestamps, values):
+    self._filter.filter(timestamps, values)
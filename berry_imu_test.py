@@ -14,7 +14,7 @@ def terminate(signal, frame):
 def test_g_load():
     load = berry_imu.Load()
     while not abort:
-        s = '\rX={0:.1f}G, Y={1:.1f}, Z={2:.1f}G    '.format(load.x, load.y, load.z)
+        s = '\rX={0:.1f}G, Y={1:.1f}, Z={2:.1f}G    '.format(*load.xyz)
         sys.stdout.write(s)
         sys.stdout.flush()
         time.sleep(0.1)
@@ -36,8 +36,39 @@ def test_attitude():
         sys.stdout.flush()
         time.sleep(0.3)
 
+def test_sampler():
+    sampler = berry_imu.IMUSampler(rate=100)
+    load = berry_imu.Load(sampler)
+    sampler.start()
+    try:
+        while not abort:
+            s = '\rX={0:.1f}G, Y={1:.1f}, Z={2:.1f}G, Samples={3}    '.format(
+                *(load.xyz + (sampler.ring.count,)))
+            sys.stdout.write(s)
+            sys.stdout.flush()
+            time.sleep(0.1)
+    finally:
+        sampler.stop()
+
+def test_fifo():
+    bus = berry_imu.IMUBus.get_instance()
+    bus.enable_fifo()
+    try:
+        while not abort:
+            acc = bus.drain_acc_fifo()
+            gyro = bus.drain_gyro_fifo()
+            s = '\rAcc samples={0}, Gyro samples={1}    '.format(
+                len(acc), len(gyro))
+            sys.stdout.write(s)
+            sys.stdout.flush()
+            time.sleep(0.05)
+    finally:
+        bus.disable_fifo()
+
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, terminate)
     #test_g_load()
     #test_environment()
+    #test_sampler()
+    #test_fifo()
     test_attitude()
@@ -1,8 +1,10 @@
+import enum
 import smbus
 import time
-from ctypes import c_short
 
+from common import pattern
 from common import unit
+from hal import bmp180_compensation
 
 
 def _convertToString(data):
@@ -11,35 +13,72 @@ def _convertToString(data):
   return str((data[1] + (256 * data[0])) / 1.2)
 
 
-def _getShort(data, index):
-  # return two bytes from data as a signed 16-bit value
-  return c_short((data[index] << 8) + data[index + 1]).value
+TEMPERATURE_CONVERSION_TIME = 0.0045  # sec
 
 
-def _getUshort(data, index):
-  # return two bytes from data as an unsigned 16-bit value
-  return (data[index] << 8) + data[index + 1]
+class Oversampling(enum.Enum):
+  """Pressure oversampling setting: (oss, max conversion time in seconds)."""
+  ULTRA_LOW_POWER = (0, 0.0045)
+  STANDARD = (1, 0.0075)
+  HIGH_RESOLUTION = (2, 0.0135)
+  ULTRA_HIGH_RESOLUTION = (3, 0.0255)
+
+  @property
+  def oss(self):
+    return self.value[0]
+
+  @property
+  def conversion_time(self):
+    return self.value[1]
 
 
 class PressureSensor(object):
+  """BMP180 barometric pressure sensor.
+
+  Measurements can be taken either with the blocking read(), or by calling
+  tick() from a shared loop. tick() never waits for a conversion: it starts
+  one, returns, and collects the result on a later call once the conversion
+  time has elapsed. Temperature drifts slowly, so it is only re-measured
+  every temperature_interval pressure readings.
+  """
 
   _DEVICE = 0x77  # Default device I2C address
   _CHIP_ID_REG_ID = 0xD0
   # Register Addresses
-  _REG_CALIB = 0xAA
   _REG_MEAS = 0xF4
   _REG_MSB = 0xF6
   _REG_LSB = 0xF7
   # Control Register Address
   _CRV_TEMP = 0x2E
   _CRV_PRES = 0x34
-  # Oversample setting
-  _OVERSAMPLE = 3  # 0 - 3
+  # Measurement states
+  _IDLE = 0
+  _MEASURING_TEMPERATURE = 1
+  _MEASURING_PRESSURE = 2
+  # Seconds after which temperature is re-measured regardless of interval.
+  _MAX_TEMPERATURE_AGE = 1.0
 
-  def __init__(self):
+  def __init__(self,
+               oversampling=Oversampling.ULTRA_HIGH_RESOLUTION,
+               temperature_interval=1):
+    """
+    Args:
+      oversampling: Oversampling setting for pressure.
+      temperature_interval: number of pressure readings per temperature
+        reading.
+    """
     self._bus = smbus.SMBus(1)  # Rev 2 Pi uses 1
     self._id, self._version = self._bus.read_i2c_block_data(
         self._DEVICE, self._CHIP_ID_REG_ID, 2)
+    self._calibration = bmp180_compensation.read_calibration(
+        self._bus, self._DEVICE)
+    self._oversampling = oversampling
+    self._temperature_interval = temperature_interval
+    self._state = PressureSensor._IDLE
+    self._ready_at = 0
+    self._ut = None
+    self._ut_time = None
+    self._pressure_count = 0
     self._temperature = None
     self._pressure = None
 
@@ -59,62 +98,223 @@ class PressureSensor(object):
   def pressure(self):
     return self._pressure
 
+  @property
+  def next_tick(self):
+    """Gets monotonic time at which tick() can make progress."""
+    return self._ready_at
+
   def read(self):
-    # Read calibration data from EEPROM
-    cal = self._bus.read_i2c_block_data(self._DEVICE, self._REG_CALIB, 22)
-
-    # Convert byte data to word values
-    AC1 = _getShort(cal, 0)
-    AC2 = _getShort(cal, 2)
-    AC3 = _getShort(cal, 4)
-    AC4 = _getUshort(cal, 6)
-    AC5 = _getUshort(cal, 8)
-    AC6 = _getUshort(cal, 10)
-    B1 = _getShort(cal, 12)
-    B2 = _getShort(cal, 14)
-    MB = _getShort(cal, 16)
-    MC = _getShort(cal, 18)
-    MD = _getShort(cal, 20)
-
-    # Read temperature
-    self._bus.write_byte_data(self._DEVICE, self._REG_MEAS, self._CRV_TEMP)
-    time.sleep(0.005)
-    (msb, lsb) = self._bus.read_i2c_block_data(self._DEVICE, self._REG_MSB, 2)
-    UT = (msb << 8) + lsb
-
-    # Read pressure
-    self._bus.write_byte_data(self._DEVICE, self._REG_MEAS,
-                              self._CRV_PRES + (self._OVERSAMPLE << 6))
-    time.sleep(0.04)
-    (msb, lsb, xsb) = self._bus.read_i2c_block_data(self._DEVICE,
-                                                    self._REG_MSB, 3)
-    UP = ((msb << 16) + (lsb << 8) + xsb) >> (8 - self._OVERSAMPLE)
-
-    # Refine temperature
-    X1 = ((UT - AC6) * AC5) >> 15
-    X2 = (MC << 11) / (X1 + MD)
-    B5 = X1 + X2
-    self._temperature = unit.Temperature((int(B5 + 8) >> 4) / 10.0,
-                                         unit.Temperature.CELSIUS)
-
-    # Refine pressure
-    B6 = B5 - 4000
-    B62 = int(B6 * B6) >> 12
-    X1 = (B2 * B62) >> 11
-    X2 = int(AC2 * B6) >> 11
-    X3 = X1 + X2
-    B3 = (((AC1 * 4 + X3) << self._OVERSAMPLE) + 2) >> 2
-
-    X1 = int(AC3 * B6) >> 13
-    X2 = (B1 * B62) >> 16
-    X3 = ((X1 + X2) + 2) >> 2
-    B4 = (AC4 * (X3 + 32768)) >> 15
-    B7 = (UP - B3) * (50000 >> self._OVERSAMPLE)
-
-    P = (B7 * 2) / B4
-
-    X1 = (int(P) >> 8) * (int(P) >> 8)
-    X1 = (X1 * 3038) >> 16
-    X2 = int(-7357 * P) >> 16
-    self._pressure = unit.Pressure((int(P + ((X1 + X2 + 3791) >> 4))) / 100.0,
-                                   unit.Pressure.MILLIBAR)
+    """Takes a measurement, blocking until it completes."""
+    if self._state == PressureSensor._MEASURING_PRESSURE:
+      conversion_time = self._oversampling.conversion_time
+    else:
+      conversion_time = TEMPERATURE_CONVERSION_TIME
+    if (self._state != PressureSensor._IDLE and
+        time.monotonic() > self._ready_at + conversion_time):
+      # The conversion pre-started by the last reading finished too long
+      # ago to count as a new measurement.
+      self._start_next()
+    while not self.tick():
+      delay = self._ready_at - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+
+  def tick(self):
+    """Advances measurement state machine without blocking.
+
+    Returns:
+      True if a new reading is available through temperature and pressure.
+    """
+    now = time.monotonic()
+    if self._state == PressureSensor._IDLE:
+      self._start_next()
+      return False
+
+    if now < self._ready_at:
+      return False
+
+    if self._state == PressureSensor._MEASURING_TEMPERATURE:
+      self._ut = bmp180_compensation.raw_temperature(
+          self._bus.read_i2c_block_data(self._DEVICE, self._REG_MSB, 2))
+      self._ut_time = now
+      self._pressure_count = 0
+      self._start_pressure()
+      return False
+
+    up = bmp180_compensation.raw_pressure(
+        self._bus.read_i2c_block_data(self._DEVICE, self._REG_MSB, 3),
+        self._oversampling.oss)
+    self._pressure_count += 1
+    # Start next conversion right away so it runs while caller does other
+    # work.
+    self._start_next()
+
+    t, p = bmp180_compensation.compensate(self._calibration, self._ut, up,
+                                          self._oversampling.oss)
+    self._temperature = unit.Temperature(t / 10.0, unit.Temperature.CELSIUS)
+    self._pressure = unit.Pressure(p / 100.0, unit.Pressure.MILLIBAR)
+    return True
+
+  def _start_next(self):
+    if (self._ut is None or
+        self._pressure_count >= self._temperature_interval or
+        time.monotonic() - self._ut_time > self._MAX_TEMPERATURE_AGE):
+      self._bus.write_byte_data(self._DEVICE, self._REG_MEAS, self._CRV_TEMP)
+      self._state = PressureSensor._MEASURING_TEMPERATURE
+      # Conversion time counts from the start command, not from the tick.
+      self._ready_at = time.monotonic() + TEMPERATURE_CONVERSION_TIME
+    else:
+      self._start_pressure()
+
+  def _start_pressure(self):
+    self._bus.write_byte_data(
+        self._DEVICE, self._REG_MEAS,
+        self._CRV_PRES + (self._oversampling.oss << 6))
+    self._state = PressureSensor._MEASURING_PRESSURE
+    self._ready_at = time.monotonic() + self._oversampling.conversion_time
+
+
+class _AlphaBetaFilter(object):
+  """Alpha-beta filter tracking a value and its rate of change."""
+
+  __slots__ = ('value', 'rate', '_alpha', '_beta', '_timestamp')
+
+  def __init__(self, alpha, beta):
+    self.value = None
+    self.rate = 0.0
+    self._alpha = alpha
+    self._beta = beta
+    self._timestamp = None
+
+  def update(self, measurement, timestamp):
+    if self._timestamp is None:
+      self.value = measurement
+      self._timestamp = timestamp
+      return
+
+    dt = timestamp - self._timestamp
+    self._timestamp = timestamp
+    predicted = self.value + self.rate * dt
+    residual = measurement - predicted
+    self.value = predicted + self._alpha * residual
+    if dt > 0:
+      self.rate += self._beta * residual / dt
+
+
+class AltimeterWorker(pattern.Worker, pattern.EventEmitter):
+  """Derives altitude and vertical speed from a BMP180 pressure stream.
+
+  Pressure altitude is smoothed by an alpha-beta filter, which also yields
+  vertical speed, at constant cost per sample. Altitudes are in meters of
+  the standard atmosphere.
+
+  Events:
+    "altitude": triggered at the configured rate once data is available.
+      altimeter (AltimeterWorker)
+  """
+
+  _STANDARD_PRESSURE = 101325.0  # Pa
+  _STANDARD_DENSITY = 1.225  # kg/m^3
+  _GAS_CONSTANT = 287.05  # J/(kg*K), dry air
+  _ALTITUDE_SCALE = 44330.8  # m
+  _PRESSURE_EXPONENT = 0.190263
+  _DENSITY_EXPONENT = 0.234969
+
+  def __init__(self,
+               sensor=None,
+               rate=10,
+               qnh=None,
+               alpha=0.1,
+               beta=0.005,
+               *args,
+               **kwargs):
+    """
+    Args:
+      sensor: PressureSensor to read. A new one is created if not given.
+      rate: frequency of "altitude" events, in Hz.
+      qnh: altimeter setting as unit.Pressure. Defaults to standard pressure.
+      alpha, beta: filter gains. Smaller values smooth more but lag more.
+    """
+    super(AltimeterWorker, self).__init__(
+        worker_name='Altimeter', *args, **kwargs)
+    self._sensor = sensor or PressureSensor()
+    self._interval = 1.0 / rate
+    self._qnh = qnh.pa if qnh else self._STANDARD_PRESSURE
+    self._filter = _AlphaBetaFilter(alpha, beta)
+    self._next_emit = 0
+
+  @property
+  def ready(self):
+    return self._filter.value is not None
+
+  @property
+  def qnh(self):
+    return unit.Pressure(self._qnh, unit.Pressure.PA)
+
+  @qnh.setter
+  def qnh(self, value):
+    self._qnh = value.pa
+
+  @property
+  def pressure_altitude(self):
+    """Gets filtered altitude relative to standard pressure."""
+    if self._filter.value is None:
+      return None
+    return unit.Length(self._filter.value, unit.Length.METER)
+
+  @property
+  def altitude(self):
+    """Gets filtered altitude relative to QNH."""
+    if self._filter.value is None:
+      return None
+    return unit.Length(
+        self._altitude(self._filtered_pressure(), self._qnh),
+        unit.Length.METER)
+
+  @property
+  def density_altitude(self):
+    """Gets altitude in standard atmosphere with the current air density."""
+    if self._filter.value is None or self._sensor.temperature is None:
+      return None
+    kelvin = self._sensor.temperature.c + 273.15
+    density = self._filtered_pressure() / (self._GAS_CONSTANT * kelvin)
+    value = self._ALTITUDE_SCALE * (1 - (density / self._STANDARD_DENSITY)**
+                                    self._DENSITY_EXPONENT)
+    return unit.Length(value, unit.Length.METER)
+
+  @property
+  def vertical_speed(self):
+    if self._filter.value is None:
+      return None
+    return unit.Speed(
+        unit.Length(self._filter.rate, unit.Length.METER), unit.ONE_SECOND)
+
+  def _on_start(self):
+    self._next_emit = time.monotonic()
+
+  def _on_run(self):
+    delay = min(self._sensor.next_tick, self._next_emit) - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+
+    if self._sensor.tick():
+      self._filter.update(
+          self._altitude(self._sensor.pressure.pa, self._STANDARD_PRESSURE),
+          time.monotonic())
+
+    now = time.monotonic()
+    if now >= self._next_emit:
+      self._next_emit += self._interval
+      if self._next_emit < now:
+        self._next_emit = now + self._interval
+      if self.ready:
+        self.emit('altitude', self)
+
+  def _altitude(self, pressure, reference):
+    return self._ALTITUDE_SCALE * (1 - (pressure / reference)**
+                                   self._PRESSURE_EXPONENT)
+
+  def _filtered_pressure(self):
+    return self._STANDARD_PRESSURE * (
+        1 - self._filter.value / self._ALTITUDE_SCALE)**(
+            1 / self._PRESSURE_EXPONENT)
@@ -0,0 +1,152 @@
+"""Temperature and pressure compensation for BMP180 barometers.
+
+Implements the integer algorithm from the BMP180 datasheet, so results match
+the datasheet bit for bit. Both a scalar path (for live readings) and a numpy
+batch path (for reprocessing logged raw values) are provided.
+"""
+
+import struct
+
+import numpy as np
+
+CALIBRATION_REGISTER = 0xAA
+_CALIBRATION = struct.Struct('>hhhHHHhhhhh')
+
+
+class Calibration(object):
+  """Factory calibration coefficients stored in BMP180 EEPROM."""
+
+  __slots__ = ('ac1', 'ac2', 'ac3', 'ac4', 'ac5', 'ac6', 'b1', 'b2', 'mb',
+               'mc', 'md')
+
+  def __init__(self, ac1, ac2, ac3, ac4, ac5, ac6, b1, b2, mb, mc, md):
+    self.ac1 = ac1
+    self.ac2 = ac2
+    self.ac3 = ac3
+    self.ac4 = ac4
+    self.ac5 = ac5
+    self.ac6 = ac6
+    self.b1 = b1
+    self.b2 = b2
+    self.mb = mb
+    self.mc = mc
+    self.md = md
+
+  @classmethod
+  def from_bytes(cls, data):
+    """Creates calibration from the 22-byte EEPROM dump."""
+    return cls(*_CALIBRATION.unpack(bytearray(data)))
+
+
+def read_calibration(bus, address):
+  """Reads calibration of a device from its EEPROM.
+
+  Args:
+    bus: SMBus instance the device is attached to.
+    address: I2C address of the device.
+  Returns:
+    Calibration instance.
+  """
+  data = bus.read_i2c_block_data(address, CALIBRATION_REGISTER,
+                                 _CALIBRATION.size)
+  return Calibration.from_bytes(data)
+
+
+def raw_temperature(data):
+  """Converts the 2 bytes read from result registers into UT."""
+  return (data[0] << 8) + data[1]
+
+
+def raw_pressure(data, oversampling):
+  """Converts the 3 bytes read from result registers into UP."""
+  return ((data[0] << 16) + (data[1] << 8) + data[2]) >> (8 - oversampling)
+
+
+def compensate(calibration, ut, up, oversampling):
+  """Computes true temperature and pressure.
+
+  Args:
+    calibration: Calibration of the device.
+    ut: raw temperature.
+    up: raw pressure.
+    oversampling: oversampling setting (0-3) used to measure up.
+  Returns:
+    (temperature, pressure) where temperature is in 0.1C and pressure in Pa.
+  """
+  c = calibration
+  x1 = ((ut - c.ac6) * c.ac5) >> 15
+  x2 = _div(c.mc << 11, x1 + c.md)
+  b5 = x1 + x2
+  temperature = (b5 + 8) >> 4
+
+  b6 = b5 - 4000
+  b62 = (b6 * b6) >> 12
+  x1 = (c.b2 * b62) >> 11
+  x2 = (c.ac2 * b6) >> 11
+  x3 = x1 + x2
+  b3 = (((c.ac1 * 4 + x3) << oversampling) + 2) >> 2
+  x1 = (c.ac3 * b6) >> 13
+  x2 = (c.b1 * b62) >> 16
+  x3 = ((x1 + x2) + 2) >> 2
+  b4 = (c.ac4 * (x3 + 32768)) >> 15
+  b7 = (up - b3) * (50000 >> oversampling)
+  p = _div(b7 * 2, b4)
+
+  x1 = (p >> 8) * (p >> 8)
+  x1 = (x1 * 3038) >> 16
+  x2 = (-7357 * p) >> 16
+  pressure = p + ((x1 + x2 + 3791) >> 4)
+  return (temperature, pressure)
+
+
+def compensate_array(calibration, ut, up, oversampling):
+  """Computes true temperature and pressure for arrays of raw readings.
+
+  Same as compensate(), applied element-wise.
+
+  Args:
+    calibration: Calibration of the device.
+    ut: array-like of raw temperatures.
+    up: array-like of raw pressures, same shape as ut.
+    oversampling: oversampling setting (0-3) used to measure up.
+  Returns:
+    (temperature, pressure) int64 arrays in 0.1C and Pa.
+  """
+  c = calibration
+  ut = np.asarray(ut, dtype=np.int64)
+  up = np.asarray(up, dtype=np.int64)
+
+  x1 = ((ut - c.ac6) * c.ac5) >> 15
+  x2 = _div_array(c.mc << 11, x1 + c.md)
+  b5 = x1 + x2
+  temperature = (b5 + 8) >> 4
+
+  b6 = b5 - 4000
+  b62 = (b6 * b6) >> 12
+  x1 = (c.b2 * b62) >> 11
+  x2 = (c.ac2 * b6) >> 11
+  x3 = x1 + x2
+  b3 = (((c.ac1 * 4 + x3) << oversampling) + 2) >> 2
+  x1 = (c.ac3 * b6) >> 13
+  x2 = (c.b1 * b62) >> 16
+  x3 = ((x1 + x2) + 2) >> 2
+  b4 = (c.ac4 * (x3 + 32768)) >> 15
+  b7 = (up - b3) * (50000 >> oversampling)
+  p = _div_array(b7 * 2, b4)
+
+  x1 = (p >> 8) * (p >> 8)
+  x1 = (x1 * 3038) >> 16
+  x2 = (-7357 * p) >> 16
+  pressure = p + ((x1 + x2 + 3791) >> 4)
+  return (temperature, pressure)
+
+
+def _div(a, b):
+  # Integer division truncating toward zero, as in the datasheet's C code.
+  q = abs(a) // abs(b)
+  return q if (a < 0) == (b < 0) else -q
+
+
+def _div_array(a, b):
+  q = np.abs(a) // np.abs(b)
+  return np.where((np.asarray(a) < 0) == (np.asarray(b) < 0), q, -q)
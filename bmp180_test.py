@@ -11,6 +11,10 @@ pressure_field = console.LabeledTextField(
     x=1, y=2, max_width=30, label='Pressure: ', fmt='{0:.2f}inHG')
 latency_field = console.LabeledTextField(
     x=40, y=1, max_width=30, label='Latency: ', fmt='{0:.0f}ms')
+altitude_field = console.LabeledTextField(
+    x=1, y=3, max_width=30, label='Altitude: ', fmt='{0}')
+vertical_speed_field = console.LabeledTextField(
+    x=40, y=3, max_width=30, label='Vertical Speed: ', fmt='{0}')
 
 
 def main():
@@ -24,5 +28,34 @@ def main():
     latency_field.set((t1 - t0) * 1000)
 
 
+def main_tick():
+  sensor = bmp180.PressureSensor(temperature_interval=10)
+  t0 = time.time()
+  while True:
+    if sensor.tick():
+      t1 = time.time()
+      temp_field.set(sensor.temperature.c)
+      pressure_field.set(sensor.pressure.inhg)
+      latency_field.set((t1 - t0) * 1000)
+      t0 = t1
+    time.sleep(max(0, sensor.next_tick - time.monotonic()))
+
+
+def main_altimeter():
+  altimeter = bmp180.AltimeterWorker(rate=10)
+  altimeter.on('altitude', _on_altitude)
+  altimeter.start()
+  try:
+    while True:
+      time.sleep(1)
+  finally:
+    altimeter.stop()
+
+
+def _on_altitude(altimeter):
+  altitude_field.set(altimeter.altitude)
+  vertical_speed_field.set(altimeter.vertical_speed)
+
+
 if __name__ == "__main__":
   main()
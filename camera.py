@@ -1,7 +1,9 @@
 import datetime
+import enum
 import flask
 import io
 import picamera
+import threading
 import time
 
 from third_party.common import clocks
@@ -82,6 +84,157 @@ class Recorder(pattern.Worker):
     self._recording = False
 
 
+class FrameBus(object):
+  """Publishes the latest frame to any number of waiting readers.
+
+  Readers wake on publish and get the newest frame only. A reader that falls
+  behind skips frames rather than queueing them, so its backlog is never
+  more than one frame. All readers get the same bytes object.
+  """
+
+  def __init__(self):
+    self._condition = threading.Condition()
+    self._sequence = 0
+    self._data = None
+    self._timestamp = None
+
+  @property
+  def sequence(self):
+    """Gets sequence number of the latest frame or clear(); 0 initially."""
+    return self._sequence
+
+  def publish(self, data, timestamp):
+    with self._condition:
+      self._sequence += 1
+      self._data = data
+      self._timestamp = timestamp
+      self._condition.notify_all()
+
+  def clear(self):
+    """Drops the latest frame, so that readers wait for the next one."""
+    with self._condition:
+      self._sequence += 1
+      self._data = None
+      self._timestamp = None
+
+  def wait(self, sequence=0, timeout=None):
+    """Waits for a frame newer than a sequence number.
+
+    Args:
+      sequence: sequence number of the last frame the reader has.
+      timeout: seconds to wait, or None to wait indefinitely.
+    Returns:
+      (sequence, data, timestamp) of the latest frame, or None on timeout.
+    """
+    with self._condition:
+      if not self._condition.wait_for(
+          lambda: self._sequence > sequence and self._data is not None,
+          timeout):
+        return None
+      return (self._sequence, self._data, self._timestamp)
+
+
+class MjpegSplitter(object):
+  """File-like output for picamera that splits an MJPEG stream into frames.
+
+  picamera may hand a frame over in several writes, and a write may end one
+  frame and start the next. Bytes are located by searching the written
+  object in place and are gathered into a preallocated buffer; each complete
+  frame (SOI to EOI) is published once as an immutable bytes object, which
+  viewers can keep sending after the buffer is reused.
+  """
+
+  _SOI = b'\xff\xd8'
+  _EOI = b'\xff\xd9'
+
+  def __init__(self, bus, capacity=1024 * 1024):
+    """
+    Args:
+      bus: FrameBus to publish frames to.
+      capacity: maximum size of a frame in bytes; larger frames are dropped.
+    """
+    self._bus = bus
+    self._buffer = bytearray(capacity)
+    self._view = memoryview(self._buffer)
+    self._size = 0
+    self._frames = 0
+    self._dropped = 0
+
+  @property
+  def frames(self):
+    return self._frames
+
+  @property
+  def dropped(self):
+    """Gets number of frames dropped for exceeding capacity."""
+    return self._dropped
+
+  def write(self, data):
+    data = memoryview(data).cast('B')
+    obj = data.obj
+    if not isinstance(obj, (bytes, bytearray)) or len(obj) != len(data):
+      # Searching needs a bytes-like object; picamera writes bytes.
+      obj = data.tobytes()
+    end = len(data)
+    pos = 0
+    if not end:
+      return 0
+    if self._size == 1 and data[0] != 0xD8:
+      # Byte held back at the end of the last write did not start an SOI.
+      self._size = 0
+    while pos < end:
+      if not self._size:
+        pos = obj.find(self._SOI, pos)
+        if pos < 0:
+          if data[end - 1] == 0xFF:
+            # Possible SOI split between writes.
+            self._buffer[0] = 0xFF
+            self._size = 1
+          break
+        stop = self._find_end(obj, pos + 2)
+      elif (self._size > 2 and self._buffer[self._size - 1] == 0xFF and
+            data[pos] == 0xD9):
+        # EOI split between writes.
+        stop = pos + 1
+      else:
+        stop = self._find_end(obj, pos)
+      complete = stop >= 0
+      if not complete:
+        stop = end
+      self._append(data[pos:stop])
+      pos = stop
+      if complete and self._size:
+        self._frames += 1
+        self._bus.publish(bytes(self._view[:self._size]), time.time())
+        self._size = 0
+    return end
+
+  def flush(self):
+    pass
+
+  def _find_end(self, data, start):
+    # Gets index just past the next EOI, or -1.
+    eoi = data.find(self._EOI, start)
+    return eoi + 2 if eoi >= 0 else -1
+
+  def _append(self, data):
+    size = self._size + len(data)
+    if size > len(self._buffer):
+      # Resynchronize on the next SOI.
+      self._dropped += 1
+      self._size = 0
+      return
+    self._view[self._size:size] = data
+    self._size = size
+
+
+class StreamMode(enum.Enum):
+  # JPEG capture from the video port, once per frame interval.
+  CAPTURE = 1
+  # Continuous MJPEG recording at the camera's frame rate.
+  MJPEG = 2
+
+
 class Streamer(pattern.Worker):
   TIMEOUT = datetime.timedelta(seconds=10)
 
@@ -92,8 +245,20 @@ class Streamer(pattern.Worker):
                height=480,
                quality=85,
                frame_rate=2,
+               mode=StreamMode.CAPTURE,
                *args,
                **kwargs):
+    """
+    Args:
+      web: flask app to serve the stream at /video, or None.
+      camera: a Camera instance.
+      width: width of frames.
+      height: height of frames.
+      quality: JPEG quality (1-100).
+      frame_rate: frames per second in CAPTURE mode; MJPEG mode runs at
+        the camera's frame rate.
+      mode: StreamMode.
+    """
     super(Streamer, self).__init__(
         worker_name='CameraStreamer', *args, **kwargs)
 
@@ -104,17 +269,21 @@ class Streamer(pattern.Worker):
     self._quality = quality
     self._min_interval = 1.0 / frame_rate
     self._camera = camera
-    self._frame = None
+    self._mode = mode
+    self._bus = FrameBus()
+    self._splitter = None
     self._expiration = datetime.datetime.now()
 
+  @property
+  def bus(self):
+    return self._bus
+
   @property
   def frame(self):
+    """Gets (data, timestamp) of the latest frame, waiting for the first."""
     self._renew()
-
-    while not self._frame:
-      time.sleep(0)
-
-    return self._frame
+    _, data, timestamp = self._bus.wait()
+    return (data, timestamp)
 
   def _renew(self):
     self._expiration = datetime.datetime.now() + Streamer.TIMEOUT
@@ -123,12 +292,27 @@ class Streamer(pattern.Worker):
 
   def _on_start(self):
     self.logger.debug('Starting streaming...')
-    self._stream = io.BytesIO()
+    if self._mode == StreamMode.MJPEG:
+      self._splitter = MjpegSplitter(self._bus)
+      self._camera.camera.start_recording(
+          self._splitter,
+          format='mjpeg',
+          splitter_port=2,
+          resize=(self._width, self._height),
+          quality=self._quality)
+    else:
+      self._stream = io.BytesIO()
 
   def _on_run(self):
     if datetime.datetime.now() > self._expiration:
       return False
 
+    if self._mode == StreamMode.MJPEG:
+      # Frames arrive on picamera's thread; this only surfaces encoder
+      # errors and checks expiration.
+      self._camera.camera.wait_recording(1, splitter_port=2)
+      return
+
     start = time.time()
     self._camera.camera.capture(
         self._stream,
@@ -138,7 +322,7 @@ class Streamer(pattern.Worker):
         quality=self._quality,
         thumbnail=None)
     self._stream.seek(0)
-    self._frame = (self._stream.read(), start)
+    self._bus.publish(self._stream.read(), start)
     self._stream.seek(0)
     self._stream.truncate()
     end = time.time()
@@ -147,7 +331,13 @@ class Streamer(pattern.Worker):
       time.sleep(delay)
 
   def _on_stop(self):
-    self._stream.close()
+    if self._mode == StreamMode.MJPEG:
+      self._camera.camera.stop_recording(splitter_port=2)
+      self._splitter = None
+    else:
+      self._stream.close()
+    # Don't serve the last frame of this session after a restart.
+    self._bus.clear()
     self.logger.debug('Stopped streaming.')
 
   def _on_video_request(self):
@@ -156,13 +346,16 @@ class Streamer(pattern.Worker):
         mimetype='multipart/x-mixed-replace; boundary=frame')
 
   def _stream_video(self):
-    last_timestamp = None
-    data, timestamp = self.frame
+    self._renew()
+    sequence = 0
     while self.is_running:
-      while self.is_running and timestamp == last_timestamp:
-        time.sleep(0.1)
-        data, timestamp = self.frame
-      last_timestamp = timestamp
+      frame = self._bus.wait(sequence, timeout=1)
+      if not frame:
+        continue
+      sequence, data, _ = frame
+      self._renew()
 
-      yield (b'--frame\r\n'
-             b'Content-Type: image/jpeg\r\n\r\n' + data + b'\r\n')
+      # Frame bytes are yielded as is, so they are shared by all clients.
+      yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+      yield data
+      yield b'\r\n'
@@ -0,0 +1,147 @@
+"""Position interpolation and extrapolation between GPS fixes.
+
+GpsInterpolator answers position queries at any rate without touching the
+serial thread: each fix is converted once into a small immutable record, and
+queries only read the latest tuple of records.
+"""
+
+import collections
+import enum
+import math
+import time
+
+EARTH_RADIUS = 6371008.8  # meters
+_MPS_PER_KNOT = 0.514444
+
+Position = collections.namedtuple('Position',
+                                  ['latitude', 'longitude', 'altitude'])
+"""Position in degrees (north and east positive) and meters."""
+
+_Fix = collections.namedtuple(
+    '_Fix', ['time', 'latitude', 'longitude', 'altitude', 'north', 'east',
+             'up'])
+
+
+class Model(enum.Enum):
+  CONSTANT_VELOCITY = 1
+  CONSTANT_ACCELERATION = 2
+
+
+class GpsInterpolator(object):
+  """Estimates position between and after GPS fixes.
+
+  Positions before the latest fix are linearly interpolated between the
+  recorded fixes. Positions after it are extrapolated from the latest fix's
+  ground speed and course (and climb, or altitude change when climb is not
+  reported), optionally with the acceleration between the last two fixes.
+  """
+
+  def __init__(self,
+               gps,
+               size=8,
+               model=Model.CONSTANT_VELOCITY,
+               max_extrapolation=1.0):
+    """
+    Args:
+      gps: neo7m.Gps to receive fixes from.
+      size: number of fixes to keep.
+      model: Model used to extrapolate past the latest fix.
+      max_extrapolation: seconds past the latest fix to extrapolate to;
+        later queries return the position at this limit.
+    """
+    self._gps = gps
+    self._size = max(size, 2)
+    self._model = model
+    self._max_extrapolation = max_extrapolation
+    # Immutable, oldest first; replaced as a whole so readers need no lock.
+    self._fixes = ()
+    gps.on('update', self._on_update)
+
+  @property
+  def fixes(self):
+    """Gets number of fixes currently kept."""
+    return len(self._fixes)
+
+  def current_position(self):
+    """Gets Position estimated for now, or None before the first fix."""
+    return self.position_at(time.monotonic())
+
+  def position_at(self, t):
+    """Gets Position estimated for a time.
+
+    Args:
+      t: time.monotonic() value.
+    Returns:
+      Position, or None before the first fix.
+    """
+    fixes = self._fixes
+    if not fixes:
+      return None
+
+    latest = fixes[-1]
+    if t < latest.time:
+      for i in range(len(fixes) - 1, 0, -1):
+        before = fixes[i - 1]
+        if t >= before.time:
+          return _interpolate(before, fixes[i], t)
+      return Position(fixes[0].latitude, fixes[0].longitude,
+                      fixes[0].altitude)
+
+    dt = min(t - latest.time, self._max_extrapolation)
+    north = latest.north * dt
+    east = latest.east * dt
+    up = latest.up * dt
+    if self._model == Model.CONSTANT_ACCELERATION and len(fixes) > 1:
+      previous = fixes[-2]
+      interval = latest.time - previous.time
+      if interval > 0:
+        k = 0.5 * dt * dt / interval
+        north += (latest.north - previous.north) * k
+        east += (latest.east - previous.east) * k
+        up += (latest.up - previous.up) * k
+    return _offset(latest, north, east, up)
+
+  def _on_update(self, gps):
+    state = gps.state
+    if state.latitude is None or state.longitude is None:
+      return
+
+    t = None
+    if gps.clock:
+      t = gps.clock.to_local(state.timestamp)
+    if t is None:
+      t = gps.fix_received
+    if t is None:
+      t = time.monotonic()
+
+    fixes = self._fixes
+    if fixes and t <= fixes[-1].time:
+      return
+
+    altitude = state.altitude if state.altitude is not None else 0.0
+    speed = (state.speed or 0.0) * _MPS_PER_KNOT
+    course = math.radians(state.track or 0.0)
+    if state.climb is not None:
+      up = state.climb
+    elif fixes:
+      up = (altitude - fixes[-1].altitude) / (t - fixes[-1].time)
+    else:
+      up = 0.0
+    fix = _Fix(t, state.latitude, state.longitude, altitude,
+               speed * math.cos(course), speed * math.sin(course), up)
+    self._fixes = fixes[1 - self._size:] + (fix,)
+
+
+def _interpolate(before, after, t):
+  k = (t - before.time) / (after.time - before.time)
+  return Position(before.latitude + (after.latitude - before.latitude) * k,
+                  before.longitude + (after.longitude - before.longitude) * k,
+                  before.altitude + (after.altitude - before.altitude) * k)
+
+
+def _offset(fix, north, east, up):
+  # Flat-earth approximation, accurate to centimeters over a second.
+  latitude = fix.latitude + math.degrees(north / EARTH_RADIUS)
+  longitude = fix.longitude + math.degrees(
+      east / (EARTH_RADIUS * math.cos(math.radians(fix.latitude))))
+  return Position(latitude, longitude, fix.altitude + up)
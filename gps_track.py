@@ -0,0 +1,249 @@
+"""Binary GPS track log.
+
+A track file is a 16-byte header followed by fixed-size little-endian
+records, one per fix, in time order:
+
+  header: magic (8s), record size (I), record count (I)
+  record: time (d, POSIX seconds UTC), latitude (d, degrees),
+          longitude (d, degrees), altitude (f, meters), speed (f, m/s),
+          course (f, degrees), mode (B), satellites (B)
+
+TrackWriter preallocates space and grows the file in large steps, and
+updates the record count in the header on every flush. TrackReader maps the
+file and exposes the records as a NumPy structured array without copying.
+
+Usage:
+  python -m hal.gps_track <track file>
+"""
+
+import datetime
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'HALTRK1\x00'
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('latitude', '<f8'),
+                         ('longitude', '<f8'), ('altitude', '<f4'),
+                         ('speed', '<f4'), ('course', '<f4'), ('mode', 'u1'),
+                         ('satellites', 'u1')])
+
+_HEADER = struct.Struct('<8sII')
+_COUNT_OFFSET = 12
+_RECORD = struct.Struct('<dddfffBB')
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MPS_PER_KNOT = 0.514444
+
+assert _RECORD.size == RECORD_DTYPE.itemsize
+
+
+class TrackException(Exception):
+  pass
+
+
+class TrackWriter(object):
+  """Appends fixes to a track file.
+
+  To log every fix of a neo7m.Gps:
+    writer = TrackWriter('flight.trk')
+    gps.on('update', writer.log_fix)
+  """
+
+  def __init__(self, path, preallocate=36000, flush_interval=1.0):
+    """
+    Args:
+      path: track file; appended to if it exists.
+      preallocate: number of records to allocate space for at a time
+        (an hour at 10Hz by default).
+      flush_interval: seconds between writes of buffered records.
+    """
+    self._preallocate = preallocate
+    self._flush_interval = flush_interval
+    self._lock = threading.Lock()
+    self._pending = bytearray()
+    self._next_flush = time.monotonic() + flush_interval
+
+    if os.path.exists(path):
+      self._file = open(path, 'r+b')
+      self._count = _read_header(self._file)
+    else:
+      self._file = open(path, 'w+b')
+      self._count = 0
+      self._file.write(_HEADER.pack(MAGIC, _RECORD.size, 0))
+    self._file.seek(0, os.SEEK_END)
+    self._capacity = (self._file.tell() - _HEADER.size) // _RECORD.size
+    self._reserve(self._count)
+
+  @property
+  def count(self):
+    """Gets number of records written, including buffered ones."""
+    return self._count + len(self._pending) // _RECORD.size
+
+  def append(self, timestamp, latitude, longitude, altitude, speed, course,
+             mode, satellites):
+    """Appends a record.
+
+    Args:
+      timestamp: POSIX seconds (UTC), or naive UTC datetime.
+      latitude, longitude: degrees, north and east positive.
+      altitude: meters.
+      speed: ground speed in m/s.
+      course: ground course in degrees.
+      mode: fix mode (1=no fix, 2=2D, 3=3D).
+      satellites: number of satellites used.
+    """
+    if isinstance(timestamp, datetime.datetime):
+      timestamp = (timestamp - _EPOCH).total_seconds()
+    with self._lock:
+      self._pending += _RECORD.pack(timestamp, latitude, longitude, altitude,
+                                    speed, course, mode, satellites)
+      if time.monotonic() >= self._next_flush:
+        self._flush()
+
+  def log_fix(self, gps):
+    """Appends the latest fix of a neo7m.Gps; usable as 'update' handler."""
+    state = gps.state
+    if (state.timestamp is None or state.latitude is None or
+        state.longitude is None):
+      return
+    self.append(state.timestamp, state.latitude, state.longitude,
+                _value(state.altitude), _value(state.speed) * _MPS_PER_KNOT,
+                _value(state.track), state.mode or 0,
+                state.satellites_used or 0)
+
+  def flush(self):
+    with self._lock:
+      self._flush()
+
+  def close(self):
+    with self._lock:
+      if self._file:
+        self._flush()
+        self._file.close()
+        self._file = None
+
+  def _flush(self):
+    self._next_flush = time.monotonic() + self._flush_interval
+    if not self._pending:
+      return
+    count = len(self._pending) // _RECORD.size
+    self._reserve(self._count + count)
+    self._file.seek(_HEADER.size + self._count * _RECORD.size)
+    self._file.write(self._pending)
+    self._count += count
+    del self._pending[:]
+    # Count is updated after the records, so readers never see a partial
+    # record.
+    self._file.seek(_COUNT_OFFSET)
+    self._file.write(struct.pack('<I', self._count))
+    self._file.flush()
+
+  def _reserve(self, count):
+    if count < self._capacity:
+      return
+    capacity = (count // self._preallocate + 1) * self._preallocate
+    size = _HEADER.size + capacity * _RECORD.size
+    if hasattr(os, 'posix_fallocate'):
+      os.posix_fallocate(self._file.fileno(), 0, size)
+    else:
+      self._file.truncate(size)
+    self._capacity = capacity
+
+
+class TrackReader(object):
+  """Memory-mapped view of a track file.
+
+  Records written after the reader is opened are not visible.
+  """
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      count = _read_header(f)
+      if count:
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+        self._mmap = None
+    if self._mmap:
+      self._records = np.frombuffer(self._mmap, RECORD_DTYPE, count,
+                                    _HEADER.size)
+    else:
+      self._records = np.zeros(0, RECORD_DTYPE)
+
+  @property
+  def records(self):
+    """Gets all records as a read-only structured array (RECORD_DTYPE)."""
+    return self._records
+
+  def __len__(self):
+    return len(self._records)
+
+  def between(self, start=None, end=None):
+    """Gets records with start <= time < end, found by binary search.
+
+    Args:
+      start: POSIX seconds or naive UTC datetime; None for the beginning.
+      end: POSIX seconds or naive UTC datetime; None for the end.
+    Returns:
+      Structured array view into the file.
+    """
+    times = self._records['time']
+    first = 0 if start is None else np.searchsorted(times, _seconds(start))
+    last = (len(times) if end is None else np.searchsorted(
+        times, _seconds(end)))
+    return self._records[first:last]
+
+  def close(self):
+    self._records = np.zeros(0, RECORD_DTYPE)
+    if self._mmap:
+      try:
+        self._mmap.close()
+      except BufferError:
+        # Arrays returned earlier are still alive; the mapping is released
+        # with the last of them.
+        pass
+      self._mmap = None
+
+
+def _read_header(f):
+  f.seek(0)
+  data = f.read(_HEADER.size)
+  if len(data) < _HEADER.size:
+    raise TrackException('Truncated track file header.')
+  magic, record_size, count = _HEADER.unpack(data)
+  if magic != MAGIC or record_size != _RECORD.size:
+    raise TrackException('Not a track file or unsupported version.')
+  return count
+
+
+def _seconds(value):
+  if isinstance(value, datetime.datetime):
+    return (value - _EPOCH).total_seconds()
+  return value
+
+
+def _value(value):
+  return value if value is not None else 0.0
+
+
+def main(path):
+  reader = TrackReader(path)
+  records = reader.records
+  print('{0}: {1} records'.format(path, len(records)))
+  if len(records):
+    print('from {0} to {1}'.format(
+        datetime.datetime.utcfromtimestamp(records['time'][0]),
+        datetime.datetime.utcfromtimestamp(records['time'][-1])))
+    print('max speed {0:.1f}m/s, max altitude {1:.1f}m'.format(
+        records['speed'].max(), records['altitude'].max()))
+  reader.close()
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print(__doc__)
+    sys.exit(1)
+  main(sys.argv[1])
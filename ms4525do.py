@@ -4,13 +4,60 @@ import sys
 import time
 import threading
 
-from common import data_filters
 from common import pattern
 from common import counters
 from common import unit
 
 
+class _RunningAverage(object):
+  """Moving average over a fixed window with O(1) updates."""
+
+  __slots__ = ('_values', '_index', '_count', '_sum')
+
+  def __init__(self, size):
+    self._values = [0] * size
+    self._index = 0
+    self._count = 0
+    self._sum = 0
+
+  @property
+  def value(self):
+    return self._sum / self._count if self._count else None
+
+  @property
+  def count(self):
+    return self._count
+
+  def reset(self):
+    self._index = 0
+    self._count = 0
+    self._sum = 0
+
+  def set(self, value):
+    size = len(self._values)
+    if self._count < size:
+      self._count += 1
+    else:
+      self._sum -= self._values[self._index]
+    self._values[self._index] = value
+    self._sum += value
+    self._index = (self._index + 1) % size
+
+
 class AirspeedSensor(pattern.Worker, pattern.EventEmitter, pattern.Singleton):
+  """MS4525DO differential pressure sensor.
+
+  Samples are taken at a fixed rate on a worker thread and smoothed with
+  moving averages. At startup, the zero offset is calibrated from the first
+  readings, so the pitot must see no airflow when the sensor starts. Derived
+  values are computed at most once per new sample, regardless of how many
+  readers there are.
+
+  Events:
+    "data": triggered for every new sample.
+      sensor (AirspeedSensor)
+  """
+
   _AIRSPEED_WINDOW_SIZE = 1000
   _TEMPERATURE_WINDOW_SIZE = 100
   _ADDRESS = 0x28
@@ -22,12 +69,50 @@ class AirspeedSensor(pattern.Worker, pattern.EventEmitter, pattern.Singleton):
   _MAX_TEMPERATURE = 150  # 150 C
   _MIN_TEMPERATURE = -50  # -50 C
   _TEMPERATURE_BITS = 11  # 11 bits, 0-2047
+  # Raw pressure count at zero differential pressure.
+  _ZERO_PRESSURE = 0.5 * (2**_PRESSURE_BITS - 1)
+  # Status bits in the first byte of a packet.
+  _STATUS_NORMAL = 0b00
+  _STATUS_STALE = 0b10
+  # Polling adapts to keep this fraction of reads stale. Polling slightly
+  # faster than the sensor updates means no fresh sample is skipped.
+  _TARGET_STALE_RATIO = 0.2
+  _ADAPT_WINDOW = 50  # reads
 
-  def __init__(self, *args, **kwargs):
+  def __init__(self,
+               sample_rate=200,
+               calibration_samples=200,
+               temperature_interval=10,
+               *args,
+               **kwargs):
+    """
+    Args:
+      sample_rate: maximum number of reads per second.
+      calibration_samples: number of samples averaged at startup to find the
+        zero offset. Set to 0 to disable calibration.
+      temperature_interval: number of fresh samples per temperature reading.
+        Other reads fetch pressure bytes only.
+    """
     super(AirspeedSensor, self).__init__(*args, **kwargs)
     self._bus = None
-    self._pressure = data_filters.SmoothValue(self._AIRSPEED_WINDOW_SIZE)
-    self._temperature = data_filters.SmoothValue(self._TEMPERATURE_WINDOW_SIZE)
+    self._min_interval = 1.0 / sample_rate
+    self._poll_interval = self._min_interval
+    self._update_interval = self._min_interval
+    self._window_reads = 0
+    self._window_stale = 0
+    self._next = None
+    self._temperature_interval = temperature_interval
+    self._fresh_count = 0
+    self._stale_count = 0
+    self._error_count = 0
+    self._stale = counters.Aggregator(1000)
+    self._calibration_samples = calibration_samples
+    self._calibration = _RunningAverage(max(calibration_samples, 1))
+    self._offset = 0
+    self._pressure = _RunningAverage(self._AIRSPEED_WINDOW_SIZE)
+    self._temperature = _RunningAverage(self._TEMPERATURE_WINDOW_SIZE)
+    self._version = 0
+    self._derived = (0, None, None, None)
     self._fetch_latency = counters.Aggregator(1000)
     self._total_latency = counters.Aggregator(1000)
 
@@ -40,6 +125,11 @@ class AirspeedSensor(pattern.Worker, pattern.EventEmitter, pattern.Singleton):
     """
     return self._pressure.value
 
+  @property
+  def zero_offset(self):
+    """Gets raw pressure count offset found by startup calibration."""
+    return self._offset
+
   @property
   def pressure(self):
     """ Gets smoothed pressure reading.
@@ -50,13 +140,7 @@ class AirspeedSensor(pattern.Worker, pattern.EventEmitter, pattern.Singleton):
     Returns:
       Pressure instance representing current pressure.
     """
-    value = float(self._pressure.value)
-    value -= 0.1 * (2**self._PRESSURE_BITS - 1)
-    value *= self._MAX_PRESSURE - self._MIN_PRESSURE
-    value /= 0.8 * (2**self._PRESSURE_BITS - 1)
-    value += self._MIN_PRESSURE
-    value = abs(value)
-    return unit.Pressure(value, unit.Pressure.PA)
+    return self._get_derived()[1]
 
   @property
   def airspeed(self):
@@ -70,9 +154,7 @@ class AirspeedSensor(pattern.Worker, pattern.EventEmitter, pattern.Singleton):
       velocity [m/s]
 
     """
-    p = self.pressure.pa
-    v = math.sqrt(abs(p) / 0.5 / 1.225) * (1 if p > 0 else -1)
-    return unit.Speed(unit.Length(v, unit.Length.METER), unit.ONE_SECOND)
+    return self._get_derived()[2]
 
   @property
   def temperature(self):
@@ -87,11 +169,7 @@ class AirspeedSensor(pattern.Worker, pattern.EventEmitter, pattern.Singleton):
     Returns:
       Temperature instance representing current temperature.
     """
-    value = float(self._temperature.value)
-    value *= (self._MAX_TEMPERATURE - self._MIN_TEMPERATURE)
-    value /= 2**self._TEMPERATURE_BITS - 1
-    value += self._MIN_TEMPERATURE
-    return unit.Temperature(value, unit.Temperature.CELSIUS)
+    return self._get_derived()[3]
 
   @property
   def fetch_latency(self):
@@ -103,26 +181,143 @@ class AirspeedSensor(pattern.Worker, pattern.EventEmitter, pattern.Singleton):
     """Gets total latency for a complete cycle."""
     return self._total_latency.average()
 
+  @property
+  def stale_ratio(self):
+    """Gets fraction of recent reads that returned stale data."""
+    return self._stale.average()
+
+  @property
+  def update_interval(self):
+    """Gets learned interval between sensor updates, in seconds."""
+    return self._update_interval
+
+  @property
+  def fresh_count(self):
+    return self._fresh_count
+
+  @property
+  def stale_count(self):
+    return self._stale_count
+
+  @property
+  def error_count(self):
+    return self._error_count
+
+  def _get_derived(self):
+    derived = self._derived
+    if derived[0] == self._version:
+      return derived
+
+    version = self._version
+    value = float(self._pressure.value) - self._offset
+    value -= 0.1 * (2**self._PRESSURE_BITS - 1)
+    value *= self._MAX_PRESSURE - self._MIN_PRESSURE
+    value /= 0.8 * (2**self._PRESSURE_BITS - 1)
+    value += self._MIN_PRESSURE
+    value = abs(value)
+    pressure = unit.Pressure(value, unit.Pressure.PA)
+
+    v = math.sqrt(value / 0.5 / 1.225)
+    airspeed = unit.Speed(unit.Length(v, unit.Length.METER), unit.ONE_SECOND)
+
+    value = float(self._temperature.value)
+    value *= (self._MAX_TEMPERATURE - self._MIN_TEMPERATURE)
+    value /= 2**self._TEMPERATURE_BITS - 1
+    value += self._MIN_TEMPERATURE
+    temperature = unit.Temperature(value, unit.Temperature.CELSIUS)
+
+    derived = (version, pressure, airspeed, temperature)
+    self._derived = derived
+    return derived
+
   def _on_start(self):
     self._pressure.reset()
     self._temperature.reset()
+    self._calibration.reset()
+    self._offset = 0
     self._bus = smbus.SMBus(1)
+    self._poll_interval = self._min_interval
+    self._update_interval = self._min_interval
+    self._window_reads = 0
+    self._window_stale = 0
+    self._next = time.monotonic()
 
   def _on_run(self):
+    delay = self._next - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+    self._schedule()
+
+    read_temperature = (self._temperature.count == 0 or
+                        self._fresh_count % self._temperature_interval == 0)
     t0 = time.time()
-    data = self._bus.read_i2c_block_data(self._ADDRESS, 4)
+    try:
+      data = self._bus.read_i2c_block_data(self._ADDRESS, 4,
+                                           4 if read_temperature else 2)
+    except IOError as e:
+      self._error_count += 1
+      self.logger.warn('Failed to read sensor: {0}'.format(e))
+      return
     t1 = time.time()
 
     # status == b00: normal operation and a good data packet
     # status == b10: stale data that has been already fetched
     status = (data[0] >> 6) & 0x03
-    if status == 0:
+    if status == self._STATUS_NORMAL:
+      self._fresh_count += 1
+      self._stale.add(0)
       raw_pressure = ((data[0] & 0x3f) << 8) | data[1]
-      raw_temperature = (data[2] << 3) | (data[3] >> 5)
-      self._pressure.set(raw_pressure)
-      self._temperature.set(raw_temperature)
-      self.emit('data', self)
+      if self._calibration.count < self._calibration_samples:
+        self._calibrate(raw_pressure)
+      else:
+        self._pressure.set(raw_pressure)
+        if read_temperature:
+          self._temperature.set((data[2] << 3) | (data[3] >> 5))
+        self._version += 1
+        self.emit('data', self)
+    elif status == self._STATUS_STALE:
+      self._stale_count += 1
+      self._stale.add(1)
+      self._window_stale += 1
+    else:
+      self._error_count += 1
 
     t2 = time.time()
     self._fetch_latency.add(t1 - t0)
     self._total_latency.add(t2 - t0)
+
+  def _schedule(self):
+    """Sets time of next read, adapting poll interval to the sensor.
+
+    Polling every T seconds a sensor that updates every S > T seconds yields
+    a stale ratio of 1 - T/S, so S = T / (1 - stale ratio). With no stale
+    reads at all, S may be shorter than T, so polling speeds up.
+    """
+    self._window_reads += 1
+    if self._window_reads >= self._ADAPT_WINDOW:
+      ratio = float(self._window_stale) / self._window_reads
+      if ratio >= 1:
+        # A fully stale window only says that S is much longer than T.
+        self._update_interval *= 2
+      elif ratio > 0:
+        self._update_interval = self._poll_interval / (1 - ratio)
+      else:
+        self._update_interval = self._poll_interval * (
+            1 - self._TARGET_STALE_RATIO)
+      self._poll_interval = max(
+          self._min_interval,
+          self._update_interval * (1 - self._TARGET_STALE_RATIO))
+      self._window_reads = 0
+      self._window_stale = 0
+
+    self._next += self._poll_interval
+    now = time.monotonic()
+    if self._next < now:
+      self._next = now + self._poll_interval
+
+  def _calibrate(self, raw_pressure):
+    self._calibration.set(raw_pressure)
+    if self._calibration.count == self._calibration_samples:
+      self._offset = self._calibration.value - self._ZERO_PRESSURE
+      self.logger.info('Zero offset calibrated to {0:.1f} counts.'.format(
+          self._offset))
@@ -19,6 +19,10 @@ fetch_latency_field = console.LabeledTextField(
     x=31, y=1, max_width=30, label='Fetch Latency: ', fmt='{0:.4f} sec')
 total_latency_field = console.LabeledTextField(
     x=31, y=2, max_width=30, label='Total Latency: ', fmt='{0:.4f} sec')
+stale_ratio_field = console.LabeledTextField(
+    x=31, y=3, max_width=30, label='Stale Ratio: ', fmt='{0:.2f}')
+update_interval_field = console.LabeledTextField(
+    x=31, y=4, max_width=30, label='Update Interval: ', fmt='{0:.4f} sec')
 
 last_update = time.time()
 
@@ -33,6 +37,8 @@ def on_data(sensor):
     temperature_field.set(sensor.temperature.c)
     fetch_latency_field.set(sensor.fetch_latency)
     total_latency_field.set(sensor.total_latency)
+    stale_ratio_field.set(sensor.stale_ratio)
+    update_interval_field.set(sensor.update_interval)
     dash.stop_update()
 
     last_update = time.time()
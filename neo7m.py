@@ -1,14 +1,20 @@
 import abc
 import datetime
 import enum
-import pynmea2
+import json
+import os
+import re
 import serial
+import struct
 import sys
 import threading
 import time
 
+from common import counters
 from common import pattern
 from common import unit
+from hal import nmea
+from hal import ubx
 
 
 class GpsMode(enum.Enum):
@@ -17,53 +23,509 @@ class GpsMode(enum.Enum):
   GPS_3D_FIX = 3
 
 
-def calc_checksum(data):
-  a = 0
-  b = 0
-  for i in data:
-    a = a + ord(i)
-    b = b + a
-  return chr(a & 0xff) + chr(b & 0xff)
+class GpsProtocol(enum.Enum):
+  NMEA = 1
+  UBX = 2
+
+
+class GpsException(Exception):
+  pass
+
+
+class GpsConnection(pattern.Logger):
+  """Opens the receiver's serial port and negotiates baud rate and update rate.
+
+  The current baud rate is found by switching a single open port between
+  candidates and returning as soon as NMEA or UBX sync bytes arrive. The
+  first candidate is the last negotiated setting, so a warm start usually
+  succeeds on the first probe. Configuration changes are confirmed by UBX
+  ACK rather than fixed delays, and negotiated settings are saved to
+  settings_path.
+  """
+
+  BAUD_RATES = (115200, 9600, 57600, 38400, 19200, 4800)
+  # Maximum navigation update rate (Hz) of the NEO-7M.
+  MAX_UPDATE_RATE = 10
+
+  # UART1, 8N1, UBX+NMEA in, UBX+NMEA out.
+  _PORT_ID = 1
+  _PORT_MODE = 0x08D0
+  _PROTOCOLS = 0x0003
+  _CFG_PRT = struct.Struct('<BBHIIHHHH')
+  _CFG_RATE = struct.Struct('<HHH')
+  # Receiver output is seen within this after a poll at the right baud rate.
+  _PROBE_TIMEOUT = 0.25
+  # One navigation epoch at the slowest (1Hz) default rate.
+  _EPOCH_TIMEOUT = 1.1
+  _NMEA_SYNC = re.compile(br'\$G[A-Z]{4},')
+  _UBX_SYNC = re.compile(re.escape(ubx.SYNC) + br'[\x01\x05\x06\x0a]')
+
+  def __init__(self,
+               port='/dev/ttyS0',
+               baudrate=115200,
+               update_rate=10,
+               settings_path='~/.neo7m.json',
+               *args,
+               **kwargs):
+    """
+    Args:
+      port: serial device of the receiver.
+      baudrate: baud rate to switch the receiver to.
+      update_rate: navigation update rate (Hz), up to MAX_UPDATE_RATE.
+      settings_path: file to persist negotiated settings in, or None.
+    """
+    super(GpsConnection, self).__init__(*args, **kwargs)
+    if baudrate not in self.BAUD_RATES:
+      raise ValueError('Unsupported baud rate: {0}'.format(baudrate))
+    if not 0 < update_rate <= self.MAX_UPDATE_RATE:
+      raise ValueError('Update rate must be in (0, {0}]Hz: {1}'.format(
+          self.MAX_UPDATE_RATE, update_rate))
+    # CFG-RATE takes the measurement period as 16-bit milliseconds.
+    self._measurement_period = int(round(1000.0 / update_rate))
+    if self._measurement_period > 0xFFFF:
+      raise ValueError('Update rate is too low: {0}Hz'.format(update_rate))
+    self._port = port
+    self._baudrate = baudrate
+    self._update_rate = update_rate
+    self._settings_path = (os.path.expanduser(settings_path)
+                           if settings_path else None)
 
+  @property
+  def port(self):
+    return self._port
+
+  @property
+  def baudrate(self):
+    return self._baudrate
+
+  @property
+  def update_rate(self):
+    return self._update_rate
+
+  def open(self, parser=None, timeout=1):
+    """Opens the port and configures the receiver.
+
+    Args:
+      parser: UbxParser used to wait for ACKs.
+      timeout: read timeout of the returned port.
+    Returns:
+      serial.Serial opened at the negotiated baud rate.
+    Raises:
+      GpsException: if the receiver does not respond at any baud rate.
+      ubx.UbxException: if the receiver rejects the configuration.
+    """
+    settings = self._load_settings()
+    ser = serial.Serial(self._port, settings.get('baudrate', self._baudrate),
+                        timeout=timeout)
+    try:
+      baudrate = self.detect_baudrate(ser, settings.get('baudrate'))
+      if baudrate != self._baudrate:
+        self._set_baudrate(ser)
+      # Rate is not kept across receiver power cycles, so always set it; the
+      # ACK arrives within milliseconds.
+      self.logger.info('Setting GPS update rate to {0}Hz...'.format(
+          self._update_rate))
+      ubx.configure(ser, ubx.CFG_RATE,
+                    self._CFG_RATE.pack(self._measurement_period, 1, 1),
+                    parser)
+    except Exception:
+      ser.close()
+      raise
+
+    ser.timeout = timeout
+    self._save_settings()
+    return ser
+
+  def detect_baudrate(self, ser, preferred=None):
+    """Finds the baud rate the receiver is currently using.
+
+    Args:
+      ser: open serial port; its baud rate is left at the detected value.
+      preferred: baud rate to try first.
+    Returns:
+      Detected baud rate.
+    Raises:
+      GpsException: if the receiver does not respond at any baud rate.
+    """
+    candidates = [preferred, self._baudrate] + list(self.BAUD_RATES)
+    tried = set()
+    # First pass polls the receiver so that a correct guess is confirmed
+    # immediately; second pass also waits for one epoch of periodic output,
+    # in case the receiver ignores input on this port.
+    for timeout in (self._PROBE_TIMEOUT, self._EPOCH_TIMEOUT):
+      tried.clear()
+      for baudrate in candidates:
+        if not baudrate or baudrate in tried:
+          continue
+        tried.add(baudrate)
+        self.logger.debug('Probing GPS at {0}...'.format(baudrate))
+        if self._probe(ser, baudrate, timeout):
+          self.logger.info('Detected GPS at {0}.'.format(baudrate))
+          return baudrate
+    raise GpsException('Unable to detect GPS baud rate.')
+
+  def _probe(self, ser, baudrate, timeout):
+    ser.baudrate = baudrate
+    ser.reset_input_buffer()
+    ser.write(ubx.frame(ubx.CFG_PRT, bytes((self._PORT_ID,))))
+    ser.flush()
+    ser.timeout = timeout
+    data = bytearray()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+      data += ser.read(ser.in_waiting or 1)
+      if self._NMEA_SYNC.search(data) or self._UBX_SYNC.search(data):
+        return True
+    return False
+
+  def _set_baudrate(self, ser):
+    self.logger.info('Setting GPS baud rate to {0}...'.format(self._baudrate))
+    # The receiver switches right after this message, so its ACK is sent at
+    # the new baud rate (or lost); confirm by probing at the new rate.
+    ser.write(
+        ubx.frame(ubx.CFG_PRT,
+                  self._CFG_PRT.pack(self._PORT_ID, 0, 0, self._PORT_MODE,
+                                     self._baudrate, self._PROTOCOLS,
+                                     self._PROTOCOLS, 0, 0)))
+    ser.flush()
+    if not self._probe(ser, self._baudrate, self._EPOCH_TIMEOUT):
+      raise GpsException('GPS did not switch to {0} baud.'.format(
+          self._baudrate))
+
+  def _load_settings(self):
+    if not self._settings_path:
+      return {}
+    try:
+      with open(self._settings_path) as f:
+        settings = json.load(f)
+    except (IOError, ValueError):
+      return {}
+    if settings.get('port') != self._port:
+      return {}
+    return settings
+
+  def _save_settings(self):
+    if not self._settings_path:
+      return
+    try:
+      with open(self._settings_path, 'w') as f:
+        json.dump({
+            'port': self._port,
+            'baudrate': self._baudrate,
+            'update_rate': self._update_rate,
+        }, f)
+    except IOError as e:
+      self.logger.warn('Failed to save GPS settings: {0}'.format(e))
+
+
+CAPTURE_MAGIC = b'HALGPS1\n'
+# Seconds since capture start, chunk size.
+_CAPTURE_CHUNK = struct.Struct('<dI')
+
+
+class ByteSource(abc.ABC):
+  """Stream of bytes from a GPS receiver."""
+
+  @abc.abstractmethod
+  def open(self, parser):
+    """Opens the source.
 
-def write(s, data):
-  data = '\xB5\x62' + data + calc_checksum(data)
-  size = s.write(data)
-  s.flush()
-  time.sleep(0.1)
+    Args:
+      parser: nmea.NmeaParser or ubx.UbxParser the bytes will be fed to.
+    """
 
+  @abc.abstractmethod
+  def read(self):
+    """Gets the next chunk of bytes, blocking until some arrive.
 
-def detect_baudrate():
-  print('Detecting GPS baud rate...')
-  baud_rates = [115200, 57600, 9600, 19200, 38400]
-  for baud_rate in baud_rates:
-    print('Attempting {0}...'.format(baud_rate))
-    with serial.Serial('/dev/ttyS0', baud_rate) as s:
-      deadline = time.time() + 3
-      while time.time() < deadline:
-        buf = s.read(1024)
-        if '\r\n$GP' in buf:
-          return baud_rate
+    Returns:
+      bytes-like chunk (possibly empty on timeout), or None at end of input.
+    """
 
-  raise Exception('Unable to detect GPS baud rate.')
+  @property
+  @abc.abstractmethod
+  def received(self):
+    """Gets time.monotonic() when the first byte of the last chunk arrived."""
+
+  @abc.abstractmethod
+  def close(self):
+    pass
 
 
-def init_gps():
-  #baud_rate = detect_baudrate()
-  baud_rate = 9600
-  if baud_rate != 115200:
-    print('Setting GPS baud rate to 115200...')
-    with serial.Serial('/dev/ttyS0', baud_rate) as s:
-      write(s, '\x06\x00\x14\x00' + '\x01\x00\x00\x00\xD0\x08\x00\x00' +
-            '\x00\xC2\x01\x00\x07\x00\x03\x00' + '\x00\x00\x00\x00')
+class SerialSource(ByteSource):
+  """Reads from the receiver's serial port, optionally recording a capture."""
 
-  print('Setting GPS update rate to 10HZ...')
-  with serial.Serial('/dev/ttyS0', 115200) as s:
-    write(s, '\x06\x08\x06\x00' + '\x64\x00\x01\x00\x01\x00')
+  def __init__(self, connection, capture_path=None):
+    """
+    Args:
+      connection: GpsConnection to open the port with.
+      capture_path: file to record received bytes to, with timestamps, for
+        ReplaySource.
+    """
+    self._connection = connection
+    self._capture_path = capture_path
+    self._ser = None
+    self._capture = None
+    self._start = None
+    self._received = None
 
+  @property
+  def received(self):
+    return self._received
+
+  def open(self, parser):
+    assert not self._ser
 
-def read():
-  with serial.Serial('/dev/ttyS0', 115200) as s:
+    ubx_parser = parser if isinstance(parser, ubx.UbxParser) else None
+    self._ser = self._connection.open(ubx_parser)
+    if ubx_parser:
+      ubx.enable_ubx_output(self._ser, ubx_parser)
+    else:
+      ubx.enable_nmea_output(self._ser)
+    if self._capture_path:
+      self._capture = open(self._capture_path, 'wb')
+      self._capture.write(CAPTURE_MAGIC)
+    self._start = time.monotonic()
+
+  def read(self):
+    # Block for the first byte, then take whatever else has arrived.
+    data = self._ser.read(1)
+    self._received = time.monotonic()
+    waiting = self._ser.in_waiting
+    if waiting:
+      data += self._ser.read(waiting)
+    if self._capture and data:
+      self._capture.write(
+          _CAPTURE_CHUNK.pack(time.monotonic() - self._start, len(data)))
+      self._capture.write(data)
+    return data
+
+  def close(self):
+    if self._ser:
+      self._ser.close()
+      self._ser = None
+    if self._capture:
+      self._capture.close()
+      self._capture = None
+
+
+class ReplaySource(ByteSource):
+  """Replays a capture file.
+
+  Captures recorded by SerialSource keep the arrival time and boundaries of
+  each chunk; any other file is treated as raw receiver output and split
+  into fixed-size chunks.
+  """
+
+  def __init__(self, path, realtime=False, chunk_size=64):
+    """
+    Args:
+      path: capture file.
+      realtime: True to deliver chunks at their original timing, False to
+        deliver them as fast as possible.
+      chunk_size: chunk size for raw files.
+    """
+    with open(path, 'rb') as f:
+      self._data = memoryview(f.read())
+    self._realtime = realtime
+    self._chunk_size = chunk_size
+    self._timed = self._data[:len(CAPTURE_MAGIC)] == CAPTURE_MAGIC
+    if realtime and not self._timed:
+      raise ValueError('{0} has no timestamps to replay in real time.'.format(
+          path))
+    self._pos = 0
+    self._start = None
+    self._received = None
+
+  @property
+  def received(self):
+    return self._received
+
+  def open(self, parser):
+    self._pos = len(CAPTURE_MAGIC) if self._timed else 0
+    self._start = time.monotonic()
+
+  def read(self):
+    data = self._data
+    pos = self._pos
+    if pos >= len(data):
+      return None
+    if not self._timed:
+      self._pos = pos + self._chunk_size
+      self._received = time.monotonic()
+      return data[pos:self._pos]
+
+    timestamp, size = _CAPTURE_CHUNK.unpack_from(data, pos)
+    pos += _CAPTURE_CHUNK.size
+    self._pos = pos + size
+    if self._realtime:
+      delay = self._start + timestamp - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+    self._received = time.monotonic()
+    return data[pos:pos + size]
+
+  def close(self):
+    self._pos = len(self._data)
+
+
+class LatencyHistogram(object):
+  """Histogram of latencies in fixed-width buckets.
+
+  The last bucket also counts everything above its upper bound.
+  """
+
+  def __init__(self, bucket_width=0.005, bucket_count=60):
+    """
+    Args:
+      bucket_width: width of each bucket in seconds.
+      bucket_count: number of buckets.
+    """
+    self._width = bucket_width
+    self._counts = [0] * bucket_count
+    self._total = 0
+    self._sum = 0.0
+
+  @property
+  def bucket_width(self):
+    return self._width
+
+  @property
+  def counts(self):
+    """Gets a copy of per-bucket counts; bucket i covers [i, i+1) widths."""
+    return list(self._counts)
+
+  @property
+  def count(self):
+    return self._total
+
+  @property
+  def mean(self):
+    return self._sum / self._total if self._total else None
+
+  def add(self, latency):
+    index = min(max(int(latency / self._width), 0), len(self._counts) - 1)
+    self._counts[index] += 1
+    self._total += 1
+    self._sum += latency
+
+  def percentile(self, p):
+    """Gets upper bound (in seconds) of the bucket containing percentile p."""
+    if not self._total:
+      return None
+    target = self._total * p / 100.0
+    seen = 0
+    for i, count in enumerate(self._counts):
+      seen += count
+      if seen >= target:
+        return (i + 1) * self._width
+    return len(self._counts) * self._width
+
+  def reset(self):
+    self._counts = [0] * len(self._counts)
+    self._total = 0
+    self._sum = 0.0
+
+
+class PpsClock(pattern.Logger):
+  """Maps the local monotonic clock to GPS time using PPS edges.
+
+  The receiver's timepulse rises at the top of each UTC second, and the fix
+  for that epoch (fractional second of 0) follows it on the serial port
+  well within a second. Pairing the two gives the offset between
+  time.monotonic() and GPS time with GPIO interrupt latency (about 0.1ms)
+  rather than serial latency (50-150ms) as the error.
+  """
+
+  # Weight of a new PPS measurement in the smoothed offset.
+  _GAIN = 0.2
+  # Larger jumps mean a missed edge or receiver time step; restart.
+  _MAX_STEP = 0.1
+
+  def __init__(self, pin, *args, **kwargs):
+    """
+    Args:
+      pin: BCM GPIO pin the receiver's timepulse output is connected to.
+    """
+    super(PpsClock, self).__init__(*args, **kwargs)
+    # Imported here so Gps works without GPIO when PPS is not used.
+    from RPi import GPIO
+
+    self._gpio = GPIO
+    self._pin = pin
+    self._edge = None
+    self._offset = None
+    self._count = 0
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(pin, GPIO.IN)
+    GPIO.add_event_detect(pin, GPIO.RISING, callback=self._on_edge)
+
+  @property
+  def synchronized(self):
+    return self._offset is not None
+
+  @property
+  def count(self):
+    """Gets number of PPS edges paired with a fix."""
+    return self._count
+
+  def discipline(self, utc, received):
+    """Pairs the latest PPS edge with a fix at a whole second.
+
+    Args:
+      utc: fix time as naive UTC datetime.
+      received: time.monotonic() when the fix arrived.
+    Returns:
+      True if the offset was updated.
+    """
+    edge = self._edge
+    if (utc is None or edge is None or utc.microsecond >= 1000 or
+        not 0 <= received - edge < 1):
+      return False
+
+    offset = _posix_time(utc) - edge
+    if self._offset is None or abs(offset - self._offset) > self._MAX_STEP:
+      if self._offset is not None:
+        self.logger.warn('PPS offset stepped by {0:.3f}s.'.format(
+            offset - self._offset))
+      self._offset = offset
+    else:
+      self._offset += self._GAIN * (offset - self._offset)
+    self._count += 1
+    return True
+
+  def to_gps_time(self, local):
+    """Converts time.monotonic() value into POSIX seconds of GPS (UTC) time."""
+    if self._offset is None:
+      return None
+    return local + self._offset
+
+  def to_local(self, utc):
+    """Converts naive UTC datetime into time.monotonic() value."""
+    if self._offset is None or utc is None:
+      return None
+    return _posix_time(utc) - self._offset
+
+  def close(self):
+    self._gpio.remove_event_detect(self._pin)
+
+  def _on_edge(self, channel):
+    self._edge = time.monotonic()
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _posix_time(utc):
+  return (utc - _EPOCH).total_seconds()
+
+
+def init_gps(port='/dev/ttyS0', baudrate=115200, update_rate=10):
+  GpsConnection(port, baudrate, update_rate).open().close()
+
+
+def read(port='/dev/ttyS0', baudrate=115200):
+  with serial.Serial(port, baudrate) as s:
     while True:
       if s.isOpen():
         while s.inWaiting() > 0:
@@ -71,155 +533,245 @@ def read():
 
 
 class Gps(pattern.Singleton, pattern.EventEmitter, pattern.Worker):
-
-  def __init__(self, *args, **kwargs):
+  """NEO-7M GPS receiver.
+
+  Events:
+    "update": triggered for each new fix (RMC sentence or NAV-PVT message).
+      gps (Gps)
+      fix_received, fix_latency and fix_age describe the fix being emitted.
+    "end": triggered when a replayed source runs out of input.
+      gps (Gps)
+  """
+
+  def __init__(self,
+               protocol=GpsProtocol.NMEA,
+               port='/dev/ttyS0',
+               baudrate=115200,
+               update_rate=10,
+               pps_pin=None,
+               source=None,
+               autostart=True,
+               *args,
+               **kwargs):
+    """
+    Args:
+      protocol: GpsProtocol to receive fixes in. UBX switches the receiver
+        to binary NAV-PVT/NAV-SOL output, which is about a third the size of
+        the equivalent NMEA.
+      port: serial device of the receiver.
+      baudrate: baud rate to switch the receiver to.
+      update_rate: navigation update rate (Hz).
+      pps_pin: BCM GPIO pin connected to the receiver's timepulse output, to
+        measure fix age against GPS time.
+      source: ByteSource to read from instead of the serial port given by
+        port, baudrate and update_rate.
+      autostart: whether to start reading immediately. Pass False to
+        subscribe to events first and then call start(), so that no event is
+        emitted before the listeners exist.
+    """
     super(Gps, self).__init__(*args, **kwargs)
 
-    init_gps()
-    self._ser = None
-    self._mode = None
-    self._timestamp = None
-    self._lon = None
-    self._lat = None
-    self._alt = None
-    self._truck = None
-    self._speed = None
-    self._climb = None
-    self._mag_var = None
-    self._gsv = []
-    self.__satellites_in_view = 0
-    self.start()
+    self._source = source or SerialSource(
+        GpsConnection(port, baudrate, update_rate))
+    self._pps = PpsClock(pps_pin) if pps_pin is not None else None
+    self._fix_received = None
+    self._fix_latency = None
+    self._fix_age = None
+    self._latency = LatencyHistogram()
+    self._age = LatencyHistogram()
+    self._average_latency = counters.Aggregator(100)
+    self._protocol = protocol
+    if protocol == GpsProtocol.UBX:
+      self._parser = ubx.UbxParser()
+      self._fix_message = ubx.NAV_PVT
+    else:
+      self._parser = nmea.NmeaParser()
+      self._fix_message = nmea.RMC
+    self._state = self._parser.state
+
+    if autostart:
+      self.start()
 
   @property
   def ready(self):
-    return self._mode and self._mode == 3
+    return self._state.mode == 3
+
+  @property
+  def state(self):
+    """Gets nmea.GpsState with raw values of the last fix.
+
+    The object is updated in place by the worker thread.
+    """
+    return self._state
 
   @property
   def mode(self):
-    if self._mode:
-      return GpsMode(self._mode)
+    if self._state.mode:
+      return GpsMode(self._state.mode)
     else:
       return None
 
   @property
   def utc(self):
-    return self._timestamp
+    return self._state.timestamp
 
   @property
   def satellites_in_view(self):
-    return self._satellites_in_view
+    return self._state.satellites_in_view
 
   @property
   def longitude(self):
-    if self._lon:
-      return unit.Angle(self._lon, unit.Angle.DEGREE,
+    if self._state.longitude is not None:
+      return unit.Angle(self._state.longitude, unit.Angle.DEGREE,
                         unit.Angle.LONGITUDE_RANGE)
     else:
       return None
 
   @property
   def latitude(self):
-    if self._lat:
-      return unit.Angle(self._lat, unit.Angle.DEGREE,
+    if self._state.latitude is not None:
+      return unit.Angle(self._state.latitude, unit.Angle.DEGREE,
                         unit.Angle.LATITUDE_RANGE)
     else:
       return None
 
   @property
   def altitude(self):
-    if self._alt:
-      return unit.Length(self._alt, unit.Length.METER)
+    if self._state.altitude is not None:
+      return unit.Length(self._state.altitude, unit.Length.METER)
     else:
       return None
 
   @property
   def ground_course(self):
-    if self._truck:
-      return unit.Angle(self._track, unit.Angle.DEGREE,
+    if self._state.track is not None:
+      return unit.Angle(self._state.track, unit.Angle.DEGREE,
                         unit.Angle.HEADING_RANGE)
     else:
       return None
 
   @property
   def ground_speed(self):
-    if self._speed:
+    if self._state.speed is not None:
       return unit.Speed(
-          unit.Length(self._speed, unit.Length.NAUTICAL_MILE), unit.ONE_HOUR)
+          unit.Length(self._state.speed, unit.Length.NAUTICAL_MILE),
+          unit.ONE_HOUR)
     else:
       return None
 
   @property
   def vertical_speed(self):
-    if self._climb:
+    # Only reported in UBX mode.
+    if self._state.climb is not None:
       return unit.Speed(
-          unit.Length(self._climb, unit.Length.METER), unit.ONE_SECOND)
+          unit.Length(self._state.climb, unit.Length.METER), unit.ONE_SECOND)
     else:
       return None
 
   @property
   def magnetic_variation(self):
-    if self._mag_var:
-      return unit.Angle(self._mag_var, unit.Angle.DEGREE,
+    if self._state.magnetic_variation is not None:
+      return unit.Angle(self._state.magnetic_variation, unit.Angle.DEGREE,
                         unit.Angle.RELATIVE_RANGE)
     else:
       return None
 
+  @property
+  def fix_received(self):
+    """Gets time.monotonic() when the chunk completing the last fix arrived.
+
+    This is when the chunk's first byte was read from the serial port.
+    """
+    return self._fix_received
+
+  @property
+  def fix_latency(self):
+    """Gets seconds between receiving the last fix and emitting it."""
+    return self._fix_latency
+
+  @property
+  def fix_age(self):
+    """Gets seconds between the last fix's epoch and emitting it.
+
+    Only available when PPS is used and synchronized.
+    """
+    return self._fix_age
+
+  @property
+  def average_latency(self):
+    return self._average_latency.average()
+
+  @property
+  def latency_histogram(self):
+    """Gets LatencyHistogram of fix_latency."""
+    return self._latency
+
+  @property
+  def age_histogram(self):
+    """Gets LatencyHistogram of fix_age."""
+    return self._age
+
+  @property
+  def messages(self):
+    """Gets number of NMEA sentences or UBX messages decoded."""
+    if self._protocol == GpsProtocol.UBX:
+      return self._parser.messages
+    return self._parser.sentences
+
+  @property
+  def errors(self):
+    """Gets number of sentences or frames dropped."""
+    return self._parser.errors
+
+  @property
+  def clock(self):
+    """Gets PpsClock, or None if PPS is not used."""
+    return self._pps
+
   def close(self):
+    if self._pps:
+      self._pps.close()
     super(self.__class__, self).close()
 
   def _on_start(self):
-    assert not self._ser
-
-    self._ser = serial.Serial('/dev/ttyS0', 115200)
-    self._reader = pynmea2.NMEAStreamReader()
+    self._source.open(self._parser)
 
   def _on_run(self):
-    data = self._ser.read(16).replace('\r', '')
-    try:
-      msgs = self._reader.next(data)
-      for msg in msgs:
-        if type(msg) == pynmea2.types.talker.GLL:
-          # Loran emulation
-          pass
-        elif type(msg) == pynmea2.types.talker.RMC:
-          # Recommended minimum specific GPS/TRANSIT data
-          self._timestamp = msg.datetime
-          self._lat = msg.latitude  # degree
-          self._lon = msg.longitude  # degree
-          self._track = msg.true_course  # degree (True)
-          self._speed = msg.spd_over_grnd  # knots
-          if msg.mag_var_dir and msg.mag_variation:
-            if msg.mag_var_dir == 'W':
-              self._mag_var = float(msg.mag_variation)  # degree
-            else:
-              self._mag_var = -float(msg.mag_variation)  # degree
-          self.emit('update', self)
-        if type(msg) == pynmea2.types.talker.VTG:
-          # Vector track and speed over ground
-          pass
-        elif type(msg) == pynmea2.types.talker.GGA:
-          # fix data
-          # msg.gps_qual: 0=invalid, 1=gps fix
-          self._alt = msg.altitude
-        elif type(msg) == pynmea2.types.talker.GSA:
-          # Satellite data
-          self._mode = int(msg.mode_fix_type)
-        elif type(msg) == pynmea2.types.talker.GSV:
-          # Satellites in view
-          if msg.num_messages != len(self._gsv):
-            self._gsv = [0] * int(msg.num_messages)
-          self._gsv[int(msg.msg_num) - 1] = int(msg.num_sv_in_view)
-          self._satellites_in_view = sum(self._gsv)
-
-    except Exception as e:
-      self.logger.warn(str(e))
+    data = self._source.read()
+    if data is None:
+      self.logger.debug('Reached end of GPS input.')
+      self.emit('end', self)
+      return False
+
+    received = self._source.received
+    for message in self._parser.feed(data):
+      if message == self._fix_message:
+        self._on_fix(received)
+
+  def _on_fix(self, received):
+    utc = self._state.timestamp
+    if self._pps:
+      self._pps.discipline(utc, received)
+    self._fix_received = received
+
+    now = time.monotonic()
+    self._fix_latency = now - received
+    self._latency.add(self._fix_latency)
+    self._average_latency.add(self._fix_latency)
+    epoch = self._pps.to_local(utc) if self._pps else None
+    if epoch is not None:
+      self._fix_age = now - epoch
+      self._age.add(self._fix_age)
+    else:
+      self._fix_age = None
+
+    self.emit('update', self)
 
   def _on_stop(self):
-    if self._ser:
-      self._ser.close()
-      self._ser = None
+    self._source.close()
 
 
 if __name__ == '__main__':
-  init_gps()
-  read()
+  connection = GpsConnection()
+  connection.open().close()
+  read(connection.port, connection.baudrate)
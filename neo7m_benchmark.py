@@ -0,0 +1,65 @@
+"""Benchmarks the Gps parsing path by replaying a capture.
+
+Usage:
+  python -m hal.neo7m_benchmark <capture file> [nmea|ubx] [realtime]
+
+The capture is either recorded by neo7m.SerialSource (capture_path) or raw
+bytes as read from the receiver. It is replayed through a Gps worker as fast
+as possible (or at original timing with "realtime"), once for CPU time and
+once under tracemalloc for allocations, since tracing slows parsing down.
+"""
+
+import sys
+import threading
+import time
+import tracemalloc
+
+from hal import neo7m
+
+
+def replay(path, protocol, realtime):
+  done = threading.Event()
+  source = neo7m.ReplaySource(path, realtime=realtime)
+  start = time.monotonic()
+  cpu_start = time.process_time()
+  gps = neo7m.Gps(protocol=protocol, source=source, autostart=False)
+  gps.on('end', lambda gps: done.set())
+  gps.start()
+  done.wait()
+  cpu = time.process_time() - cpu_start
+  elapsed = time.monotonic() - start
+  gps.stop()
+  return gps, cpu, elapsed
+
+
+def main(path, protocol='nmea', realtime=None):
+  protocol = neo7m.GpsProtocol[protocol.upper()]
+  realtime = realtime == 'realtime'
+
+  gps, cpu, elapsed = replay(path, protocol, realtime)
+  messages = gps.messages
+  print('{0}: {1} messages, {2} fixes, {3} errors'.format(
+      path, messages, gps.latency_histogram.count, gps.errors))
+  print('{0:.3f}s elapsed, {1:.3f}s CPU'.format(elapsed, cpu))
+  if messages and cpu:
+    print('{0:.0f} messages/s, {1:.1f}us CPU/message'.format(
+        messages / cpu, cpu / messages * 1e6))
+
+  tracemalloc.start()
+  before = tracemalloc.take_snapshot()
+  replay(path, protocol, False)
+  after = tracemalloc.take_snapshot()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  stats = after.compare_to(before, 'lineno')
+  print('allocations: {0} bytes peak, {1} bytes in {2} blocks retained'.format(
+      peak, sum(x.size_diff for x in stats), sum(x.count_diff for x in stats)))
+  for stat in stats[:5]:
+    print('  {0}'.format(stat))
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print(__doc__)
+    sys.exit(1)
+  main(*sys.argv[1:4])
@@ -31,6 +31,9 @@ def on_update(gps):
       gps.latitude, gps.longitude, gps.altitude))
   stdscr.addstr(2, 0, 'Speed={0}, Track={1}, Vertical Speed={2}'.format(
       gps.ground_speed, gps.ground_course, gps.vertical_speed))
+  stdscr.addstr(3, 0, 'Latency={0:.1f}ms, p95={1}, Age={2}'.format(
+      gps.fix_latency * 1000, gps.latency_histogram.percentile(95),
+      gps.fix_age))
   stdscr.refresh()
 
 
@@ -0,0 +1,198 @@
+"""Streaming NMEA 0183 parser for GPS receivers.
+
+Only the sentences needed for a position fix (RMC, GGA, GSA and GSV) are
+decoded; all others are skipped by their sentence type before any field is
+touched. Parsed fields are stored in a GpsState instance that is updated in
+place.
+"""
+
+import datetime
+
+RMC = b'RMC'
+GGA = b'GGA'
+GSA = b'GSA'
+GSV = b'GSV'
+
+# Sentences longer than this are garbage (NMEA limit is 82 characters).
+_MAX_BUFFER_SIZE = 4096
+
+
+class GpsState(object):
+  """Latest values reported by a GPS receiver.
+
+  Attributes are None until reported. Angles are in degrees, with north and
+  east positive; speed is in knots, altitude in meters and climb in m/s.
+  """
+
+  __slots__ = ('timestamp', 'latitude', 'longitude', 'altitude', 'track',
+               'speed', 'climb', 'magnetic_variation', 'mode', 'quality',
+               'satellites_used', 'satellites_in_view', 'pdop', 'hdop',
+               'vdop')
+
+  def __init__(self):
+    for name in GpsState.__slots__:
+      setattr(self, name, None)
+
+
+class NmeaParser(object):
+  """Incremental parser for a stream of NMEA sentences.
+
+  Bytes can be fed in chunks of any size; partial sentences are kept in a
+  reusable buffer until their line ending arrives.
+  """
+
+  def __init__(self, state=None):
+    self._state = state or GpsState()
+    self._buffer = bytearray()
+    self._handlers = {
+        RMC: self._parse_rmc,
+        GGA: self._parse_gga,
+        GSA: self._parse_gsa,
+        GSV: self._parse_gsv,
+    }
+    self._sentences = 0
+    self._errors = 0
+
+  @property
+  def state(self):
+    return self._state
+
+  @property
+  def sentences(self):
+    """Gets number of sentences decoded."""
+    return self._sentences
+
+  @property
+  def errors(self):
+    """Gets number of sentences dropped due to bad checksum or fields."""
+    return self._errors
+
+  def feed(self, data):
+    """Parses available sentences.
+
+    Args:
+      data: bytes received from the receiver.
+    Returns:
+      List of sentence types (e.g. RMC) decoded from complete sentences.
+    """
+    buf = self._buffer
+    buf += data
+    parsed = []
+    start = 0
+    while True:
+      end = buf.find(b'\r\n', start)
+      if end < 0:
+        break
+      sentence = self._parse(buf, start, end)
+      if sentence:
+        parsed.append(sentence)
+      start = end + 2
+
+    if start:
+      del buf[:start]
+    elif len(buf) > _MAX_BUFFER_SIZE:
+      del buf[:]
+    return parsed
+
+  def _parse(self, buf, start, end):
+    begin = buf.find(b'$', start, end)
+    # Shortest sentence is "$ttsss*hh".
+    if begin < 0 or end - begin < 9:
+      return None
+
+    # Skip on sentence type before validating or decoding anything else.
+    sentence = bytes(buf[begin + 3:begin + 6])
+    handler = self._handlers.get(sentence)
+    if not handler:
+      return None
+
+    star = end - 3
+    if buf[star] != 0x2A:  # '*'
+      self._errors += 1
+      return None
+    try:
+      checksum = int(buf[star + 1:end], 16)
+      if _xor(buf[begin + 1:star]) != checksum:
+        self._errors += 1
+        return None
+      handler(bytes(buf[begin + 7:star]).split(b','))
+    except (ValueError, IndexError):
+      self._errors += 1
+      return None
+
+    self._sentences += 1
+    return sentence
+
+  def _parse_rmc(self, fields):
+    # Recommended minimum specific GPS/TRANSIT data
+    state = self._state
+    state.timestamp = _datetime(fields[8], fields[0])
+    state.latitude = _angle(fields[2], fields[3], b'S')
+    state.longitude = _angle(fields[4], fields[5], b'W')
+    state.speed = _float(fields[6])
+    state.track = _float(fields[7])
+    if fields[9] and fields[10]:
+      if fields[10] == b'W':
+        state.magnetic_variation = float(fields[9])
+      else:
+        state.magnetic_variation = -float(fields[9])
+
+  def _parse_gga(self, fields):
+    # Fix data; quality: 0=invalid, 1=gps fix, 2=dgps fix
+    state = self._state
+    state.quality = _int(fields[5])
+    state.satellites_used = _int(fields[6])
+    state.hdop = _float(fields[7])
+    state.altitude = _float(fields[8])
+
+  def _parse_gsa(self, fields):
+    # Satellite data; fix type: 1=no fix, 2=2D, 3=3D
+    state = self._state
+    state.mode = _int(fields[1])
+    state.pdop = _float(fields[14])
+    state.hdop = _float(fields[15])
+    state.vdop = _float(fields[16])
+
+  def _parse_gsv(self, fields):
+    # Satellites in view; every message of a group repeats the total.
+    self._state.satellites_in_view = _int(fields[2])
+
+
+def _xor(data):
+  """Computes XOR of all bytes by folding them as one integer."""
+  value = int.from_bytes(data, 'big')
+  size = len(data)
+  while size > 1:
+    half = size // 2
+    value = (value >> (8 * half)) ^ (value & ((1 << (8 * half)) - 1))
+    size -= half
+  return value
+
+
+def _float(field):
+  return float(field) if field else None
+
+
+def _int(field):
+  return int(field) if field else None
+
+
+def _angle(field, hemisphere, negative):
+  """Converts (d)ddmm.mmmm and hemisphere into signed degrees."""
+  if not field:
+    return None
+  dot = field.find(b'.')
+  if dot < 0:
+    dot = len(field)
+  value = int(field[:dot - 2]) + float(field[dot - 2:]) / 60
+  return -value if hemisphere == negative else value
+
+
+def _datetime(date, time):
+  if not date or not time:
+    return None
+  seconds = float(time[4:])
+  whole = int(seconds)
+  return datetime.datetime(2000 + int(date[4:6]), int(date[2:4]),
+                           int(date[0:2]), int(time[0:2]), int(time[2:4]),
+                           whole, int(round((seconds - whole) * 1000000)))
@@ -0,0 +1,65 @@
+"""Benchmarks NMEA parsing against a recorded log.
+
+Usage:
+  python -m hal.nmea_benchmark <log file> [chunk size]
+
+The log is raw bytes as read from the receiver's serial port. It is fed to
+the parser in chunks, as the Gps worker would, and compared with pynmea2
+when that is installed.
+"""
+
+import sys
+import time
+
+from hal import nmea
+
+
+def benchmark_nmea(data, chunk_size):
+  parser = nmea.NmeaParser()
+  start = time.process_time()
+  for i in range(0, len(data), chunk_size):
+    parser.feed(data[i:i + chunk_size])
+  elapsed = time.process_time() - start
+  return parser.sentences, parser.errors, elapsed
+
+
+def benchmark_pynmea2(data, chunk_size):
+  import pynmea2
+
+  reader = pynmea2.NMEAStreamReader(errors='ignore')
+  text = data.decode('ascii', 'ignore').replace('\r', '')
+  count = 0
+  start = time.process_time()
+  for i in range(0, len(text), chunk_size):
+    count += len(reader.next(text[i:i + chunk_size]))
+  elapsed = time.process_time() - start
+  return count, elapsed
+
+
+def main(path, chunk_size=16):
+  with open(path, 'rb') as f:
+    data = f.read()
+  lines = data.count(b'\n')
+  print('{0}: {1} bytes, {2} lines, {3} byte chunks'.format(
+      path, len(data), lines, chunk_size))
+
+  sentences, errors, elapsed = benchmark_nmea(data, chunk_size)
+  print('nmea:    {0} decoded, {1} errors, {2:.3f}s, {3:.0f} lines/s, '
+        '{4:.1f}us/line'.format(sentences, errors, elapsed,
+                               lines / elapsed, elapsed / lines * 1e6))
+
+  try:
+    count, elapsed = benchmark_pynmea2(data, chunk_size)
+  except ImportError:
+    print('pynmea2: not installed')
+    return
+  print('pynmea2: {0} decoded, {1:.3f}s, {2:.0f} lines/s, '
+        '{3:.1f}us/line'.format(count, elapsed, lines / elapsed,
+                               elapsed / lines * 1e6))
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print(__doc__)
+    sys.exit(1)
+  main(sys.argv[1], *[int(x) for x in sys.argv[2:3]])
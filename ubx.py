@@ -0,0 +1,265 @@
+"""u-blox UBX binary protocol.
+
+Frames are parsed in place: received bytes are appended to a preallocated
+buffer and messages are decoded from it with struct.unpack_from, without
+slicing out per-frame copies. Decoded navigation data is stored in a
+nmea.GpsState, so UBX and NMEA streams can be used interchangeably.
+"""
+
+import datetime
+import itertools
+import struct
+import time
+
+from hal import nmea
+
+SYNC = b'\xb5\x62'
+
+NAV = 0x01
+ACK = 0x05
+CFG = 0x06
+NMEA = 0xF0
+
+NAV_SOL = (NAV, 0x06)
+NAV_PVT = (NAV, 0x07)
+ACK_NAK = (ACK, 0x00)
+ACK_ACK = (ACK, 0x01)
+CFG_PRT = (CFG, 0x00)
+CFG_MSG = (CFG, 0x01)
+CFG_RATE = (CFG, 0x08)
+
+# Standard NMEA message ids, as used in CFG-MSG.
+NMEA_MESSAGES = [(NMEA, i) for i in range(6)]  # GGA, GLL, GSA, GSV, RMC, VTG
+# NMEA messages decoded by nmea.NmeaParser.
+NMEA_PARSED_MESSAGES = [(NMEA, i) for i in (0, 2, 3, 4)]  # GGA, GSA, GSV, RMC
+
+_HEADER = struct.Struct('<BBH')
+_ACK = struct.Struct('<BB')
+# First 78 bytes of NAV-PVT, common to protocol versions 14 and later.
+_NAV_PVT = struct.Struct('<IHBBBBBBIiBBBBiiiiIIiiiiiIIH')
+_NAV_SOL = struct.Struct('<IihBBiiiIiiiIHBB')
+
+_MAX_PAYLOAD = 1024
+_KNOTS_PER_MPS = 1.943844
+# NAV-PVT valid flags
+_VALID_DATE = 0x01
+_VALID_TIME = 0x02
+# NAV-PVT fixType / NAV-SOL gpsFix to NMEA GSA fix type
+_FIX_MODES = {2: 2, 3: 3, 4: 3}
+
+
+class UbxException(Exception):
+  pass
+
+
+def checksum(data):
+  """Computes 8-bit Fletcher checksum over class, id, length and payload."""
+  sums = list(itertools.accumulate(data))
+  if not sums:
+    return b'\x00\x00'
+  return bytes((sums[-1] & 0xff, sum(sums) & 0xff))
+
+
+def frame(message, payload=b''):
+  """Builds a UBX frame.
+
+  Args:
+    message: (class, id) tuple, e.g. CFG_RATE.
+    payload: message payload bytes.
+  """
+  body = _HEADER.pack(message[0], message[1], len(payload)) + payload
+  return SYNC + body + checksum(body)
+
+
+def configure(port, message, payload, parser=None, timeout=1.0):
+  """Sends a configuration message and waits for it to be acknowledged.
+
+  Args:
+    port: open serial port with a read timeout.
+    message: (class, id) of a CFG message.
+    payload: message payload bytes.
+    parser: UbxParser to feed received bytes to. Other messages received
+      while waiting are decoded as usual.
+    timeout: seconds to wait for ACK.
+  Raises:
+    UbxException: if receiver replies with NAK or does not reply in time.
+  """
+  parser = parser or UbxParser()
+  port.write(frame(message, payload))
+  port.flush()
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    parser.feed(port.read(port.in_waiting or 1))
+    for acked, ok in parser.take_acks():
+      if acked == message:
+        if not ok:
+          raise UbxException('Message {0} rejected.'.format(message))
+        return
+  raise UbxException('Message {0} not acknowledged.'.format(message))
+
+
+def set_message_rate(port, message, rate, parser=None):
+  """Sets how often (per navigation solution) a message is output."""
+  configure(port, CFG_MSG, struct.pack('<BBB', message[0], message[1], rate),
+            parser)
+
+
+def enable_ubx_output(port, parser=None):
+  """Switches receiver output from NMEA to NAV-PVT and NAV-SOL."""
+  for message in NMEA_MESSAGES:
+    set_message_rate(port, message, 0, parser)
+  set_message_rate(port, NAV_PVT, 1, parser)
+  set_message_rate(port, NAV_SOL, 1, parser)
+
+
+def enable_nmea_output(port, parser=None):
+  """Switches receiver output back from UBX to NMEA.
+
+  enable_ubx_output() only changes the receiver's RAM configuration, which
+  persists until it is power cycled.
+  """
+  set_message_rate(port, NAV_PVT, 0, parser)
+  set_message_rate(port, NAV_SOL, 0, parser)
+  for message in NMEA_PARSED_MESSAGES:
+    set_message_rate(port, message, 1, parser)
+
+
+class UbxParser(object):
+  """Incremental parser for a stream of UBX frames."""
+
+  def __init__(self, state=None, capacity=4096):
+    self._state = state or nmea.GpsState()
+    self._buffer = bytearray(capacity)
+    self._view = memoryview(self._buffer)
+    self._start = 0
+    self._end = 0
+    self._acks = []
+    self._handlers = {
+        NAV_PVT: self._parse_nav_pvt,
+        NAV_SOL: self._parse_nav_sol,
+        ACK_ACK: self._parse_ack,
+        ACK_NAK: self._parse_ack,
+    }
+    self._messages = 0
+    self._errors = 0
+
+  @property
+  def state(self):
+    return self._state
+
+  @property
+  def messages(self):
+    """Gets number of messages decoded."""
+    return self._messages
+
+  @property
+  def errors(self):
+    """Gets number of frames dropped due to bad checksum or length."""
+    return self._errors
+
+  def take_acks(self):
+    """Gets and clears ((class, id), acknowledged) pairs received so far."""
+    acks = self._acks
+    self._acks = []
+    return acks
+
+  def feed(self, data):
+    """Parses available frames.
+
+    Args:
+      data: bytes received from the receiver.
+    Returns:
+      List of (class, id) of messages decoded from complete frames.
+    """
+    self._append(data)
+    buf = self._buffer
+    parsed = []
+    pos = self._start
+    end = self._end
+    while True:
+      pos = buf.find(SYNC, pos, end)
+      if pos < 0:
+        # Keep a trailing partial sync byte.
+        pos = end - 1 if end > self._start and buf[end - 1] == 0xB5 else end
+        break
+      if end - pos < 8:
+        break
+      msg_class, msg_id, length = _HEADER.unpack_from(buf, pos + 2)
+      if length > _MAX_PAYLOAD:
+        self._errors += 1
+        pos += 2
+        continue
+      frame_end = pos + 8 + length
+      if frame_end > end:
+        break
+      if checksum(self._view[pos + 2:frame_end - 2]) != buf[frame_end -
+                                                            2:frame_end]:
+        self._errors += 1
+        pos += 2
+        continue
+
+      message = (msg_class, msg_id)
+      handler = self._handlers.get(message)
+      if handler:
+        handler(buf, pos + 6, length)
+        self._messages += 1
+        parsed.append(message)
+      pos = frame_end
+
+    self._start = pos
+    return parsed
+
+  def _append(self, data):
+    size = len(data)
+    if self._end + size > len(self._buffer):
+      # Compact pending bytes to the front, dropping them if they alone
+      # would overflow the buffer.
+      pending = self._end - self._start
+      if pending + size > len(self._buffer):
+        pending = 0
+        self._errors += 1
+        if size > len(self._buffer):
+          data = data[-len(self._buffer):]
+          size = len(data)
+      self._buffer[:pending] = self._buffer[self._end - pending:self._end]
+      self._start = 0
+      self._end = pending
+    self._buffer[self._end:self._end + size] = data
+    self._end += size
+
+  def _parse_nav_pvt(self, buf, offset, length):
+    if length < _NAV_PVT.size:
+      self._errors += 1
+      return
+    (_, year, month, day, hour, minute, second, valid, _, nano, fix_type, _,
+     _, num_sv, lon, lat, _, height_msl, _, _, _, _, vel_d, ground_speed,
+     heading, _, _, pdop) = _NAV_PVT.unpack_from(buf, offset)
+
+    state = self._state
+    if valid & (_VALID_DATE | _VALID_TIME) == _VALID_DATE | _VALID_TIME:
+      state.timestamp = datetime.datetime(
+          year, month, day, hour, minute, second) + datetime.timedelta(
+              microseconds=nano // 1000)
+    state.mode = _FIX_MODES.get(fix_type, 1)
+    state.satellites_used = num_sv
+    state.longitude = lon * 1e-7
+    state.latitude = lat * 1e-7
+    state.altitude = height_msl * 1e-3
+    state.speed = ground_speed * 1e-3 * _KNOTS_PER_MPS
+    state.track = heading * 1e-5
+    state.climb = -vel_d * 1e-3
+    state.pdop = pdop * 0.01
+
+  def _parse_nav_sol(self, buf, offset, length):
+    if length < _NAV_SOL.size:
+      self._errors += 1
+      return
+    values = _NAV_SOL.unpack_from(buf, offset)
+    state = self._state
+    state.mode = _FIX_MODES.get(values[3], 1)
+    state.pdop = values[13] * 0.01
+    state.satellites_used = values[15]
+
+  def _parse_ack(self, buf, offset, length):
+    msg_class, msg_id = _ACK.unpack_from(buf, offset)
+    self._acks.append(((msg_class, msg_id), buf[offset - 3] == ACK_ACK[1]))